@@ -1,17 +1,27 @@
 """Various utilities for EEG processing"""
 
 import os
+import glob
+import json
+import hashlib
+import re
 import datetime
+import calendar
+import contextlib
 import tempfile
 import logging
 import sys
+import traceback
+import concurrent.futures
 try:
-    import ConfigParser as configparser
+    import resource
 except ImportError:
-    import configparser
+    resource = None
 
 import numpy as np
 
+from . import __version__
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -20,10 +30,128 @@ handler.setLevel(logging.INFO)
 
 logger.addHandler(handler)
 
+# FIF tag kinds, block kinds, data types and codes, as defined by the FIFF
+# specification (and mirrored in ``mne.io.constants``)
+_FIFF_FILE_ID = 100
+_FIFF_DIR_POINTER = 101
+_FIFF_BLOCK_START = 104
+_FIFF_BLOCK_END = 105
+_FIFF_FREE_LIST = 106
+_FIFF_NOP = 108
+_FIFF_NCHAN = 200
+_FIFF_SFREQ = 201
+_FIFF_CH_INFO = 203
+_FIFF_MEAS_DATE = 204
+_FIFF_DIG_POINT = 213
+_FIFF_LOWPASS = 219
+_FIFF_HIGHPASS = 223
+_FIFF_DATA_BUFFER = 300
+
+_FIFFB_MEAS = 100
+_FIFFB_MEAS_INFO = 101
+_FIFFB_RAW_DATA = 102
+_FIFFB_ISOTRAK = 107
+
+_FIFFT_VOID = 0
+_FIFFT_INT = 3
+_FIFFT_FLOAT = 4
+_FIFFT_CH_INFO_STRUCT = 30
+_FIFFT_ID_STRUCT = 31
+_FIFFT_DIG_POINT_STRUCT = 33
+
+_FIFFC_VERSION = 65540
+
+_FIFFV_EEG_CH = 2
+_FIFFV_STIM_CH = 3
+_FIFFV_EOG_CH = 202
+_FIFFV_MISC_CH = 502
+
+_FIFFV_COIL_NONE = 0
+_FIFFV_COIL_EEG = 1
+
+_FIFF_UNIT_NONE = -1
+_FIFF_UNIT_V = 107
+
+_FIFFV_POINT_CARDINAL = 1
+_FIFFV_POINT_HPI = 2
+_FIFFV_POINT_EEG = 3
+_FIFFV_POINT_EXTRA = 4
+
+_FIF_CH_INFO_DTYPE = np.dtype(
+    [
+        ("scan_no", ">i4"),
+        ("log_no", ">i4"),
+        ("kind", ">i4"),
+        ("range", ">f4"),
+        ("cal", ">f4"),
+        ("coil_type", ">i4"),
+        ("loc", ">f4", (12,)),
+        ("unit", ">i4"),
+        ("unit_mul", ">i4"),
+        ("ch_name", "S16")
+    ]
+)
+
+_FIF_DIG_POINT_DTYPE = np.dtype(
+    [
+        ("kind", ">i4"),
+        ("ident", ">i4"),
+        ("r", ">f4", (3,))
+    ]
+)
+
+# digitiser points, as read from a Polhemus 'pos' file, with positions in mm
+_DIG_POINTS_DTYPE = np.dtype(
+    [
+        ("category", "U8"),
+        ("identifier", np.int32),
+        ("x", np.float64),
+        ("y", np.float64),
+        ("z", np.float64)
+    ]
+)
+
+# the channel name at the start of a row of an ASCII BrainVision data file
+_DAT_NAME_PATTERN = re.compile(r"\s*(\S+)")
+
+# default memory budget of a streaming BDF conversion, in bytes
+_DEFAULT_MAX_MEMORY = 256 * 1024 ** 2
+
+# parsed BrainVision headers, by absolute path, with the modification time
+# and size of the file they were parsed from
+_VHDR_CACHE = {}
+
+# multipliers to take a BDF/EDF physical dimension to volts, with micro as
+# "u" or as the micro sign or Greek mu that some EDF writers use
+_VOLTAGE_UNITS = {
+    "V": 1.0,
+    "mV": 1e-3,
+    "uV": 1e-6,
+    u"\u00b5V": 1e-6,
+    u"\u03bcV": 1e-6,
+    "nV": 1e-9
+}
+
+
+def convert_bdf_to_fiff(
+    bdf_path,
+    fif_path,
+    pos_path=None,
+    chunk_records=None,
+    max_memory=None,
+    manifest_path=None,
+    alias_path=None
+):
+    """Convert a dataset in BioSemi BDF format (or in EDF/EDF+ format) into
+    MNE FIF format, adding digitiser information and fixing lost information
+    along the way.
 
-def convert_bdf_to_fiff(bdf_path, fif_path, pos_path=None):
-    """Convert a dataset in BioSemi BDF format into MNE FIF format, adding
-    digitiser information and fixing lost information along the way.
+    The data are streamed through in chunks of data records, so the full
+    recording is never held in memory. The channel names and types are set
+    as the channel information is written, so the output does not need a
+    separate pass through ``fix_channel_types``. The FIF file is moved into
+    place only once it is complete, so a failed conversion never leaves a
+    partial file behind.
 
     Parameters
     ----------
@@ -31,45 +159,390 @@ def convert_bdf_to_fiff(bdf_path, fif_path, pos_path=None):
         Paths to the input and output, respectively.
     pos_path: string, optional
         Path to a Polhemus localiser file. This gets converted to a HPTS file.
+    chunk_records: int, optional
+        Number of BDF data records to read, decode, and write at a time.
+    max_memory: int, optional
+        Approximate limit, in bytes, on the memory used by the chunk buffers.
+        Used to set ``chunk_records`` if that is not given; defaults to 256
+        MB.
+    manifest_path: string, optional
+        Path to a conversion manifest (see ``is_conversion_current``). If
+        given, the conversion is skipped when ``fif_path`` is up to date with
+        its inputs, and is recorded in the manifest otherwise.
+    alias_path: string, optional
+        Path to a channel alias file, as used by ``fix_channel_types``. If not
+        given, the standard for the 64-channel setup at UNSW is applied.
 
     """
 
+    if chunk_records is not None and max_memory is not None:
+        raise ValueError("Only one of chunk_records and max_memory can be set")
+
+    input_paths = [
+        input_path
+        for input_path in [bdf_path, pos_path, alias_path]
+        if input_path is not None
+    ]
+
+    params = {"converter": "convert_bdf_to_fiff"}
+
+    if manifest_path is not None and is_conversion_current(
+        manifest_path=manifest_path,
+        output_path=fif_path,
+        input_paths=input_paths,
+        params=params
+    ):
+        logger.info(fif_path + " is up to date; skipping")
+        return
+
     if pos_path is not None:
 
-        # first step is to convert the POS file to HPTS
+        # first step is to read the POS file, and save it as HPTS
         (pos_base, _) = os.path.splitext(pos_path)
 
         hpts_path = pos_base + ".hpts"
 
-        convert_fastrak_to_hpts(pos_path=pos_path, hpts_path=hpts_path)
+        points = read_fastrak_pos(pos_path=pos_path)
+
+        _write_hpts(points=points, pos_path=pos_path, hpts_path=hpts_path)
+
+        dig = _points_to_dig(points=points)
+
+    else:
+
+        dig = None
+
+    header = read_bdf_header(bdf_path=bdf_path)
+
+    _check_bdf_sampling(header=header)
+
+    n_records = header["n_records"]
+    n_signals = header["n_signals"]
+    n_per_record = header["samples_per_record"][0]
+
+    if chunk_records is None:
+
+        if max_memory is None:
+            max_memory = _DEFAULT_MAX_MEMORY
+
+        # each sample is held as raw bytes and a float32 physical value
+        chunk_records = int(
+            max_memory //
+            (n_signals * n_per_record * (header["sample_bytes"] + 4))
+        )
+
+    chunk_records = max(1, min(chunk_records, n_records))
+
+    if alias_path is None:
+        aliases = _get_default_channel_aliases()
+    else:
+        aliases = _read_channel_aliases(alias_path=alias_path)
+
+    ch_names = []
+    ch_kinds = []
+
+    for label in header["labels"]:
+
+        if label == "Status":
+            ch_kind = _FIFFV_STIM_CH
+        else:
+            ch_kind = _FIFFV_EEG_CH
+
+        (ch_name, alias_kind) = aliases.get(label, (label, None))
+
+        ch_names.append(ch_name)
+        ch_kinds.append(ch_kind if alias_kind is None else alias_kind)
+
+    # buffers that are re-used for every chunk
+    raw = np.empty((chunk_records, header["record_bytes"]), np.uint8)
+    physical = np.empty((n_signals, chunk_records * n_per_record), np.float32)
+
+    with open(bdf_path, "rb") as bdf_file, _open_atomic(
+        fif_path, mode="wb"
+    ) as fif_file:
+
+        bdf_file.seek(header["header_bytes"])
+
+        _start_raw_fif(
+            fif_file=fif_file,
+            header=header,
+            ch_names=ch_names,
+            ch_kinds=ch_kinds,
+            dig=dig
+        )
+
+        for i_record in range(0, n_records, chunk_records):
+
+            n_chunk = min(chunk_records, n_records - i_record)
+            n_samples = n_chunk * n_per_record
+
+            if bdf_file.readinto(raw[:n_chunk]) != raw[:n_chunk].nbytes:
+                raise ValueError(
+                    "Data records of " + bdf_path + " are truncated"
+                )
+
+            chunk = physical[:, :n_samples]
+
+            _decode_bdf_records(
+                records=raw[:n_chunk], header=header, out=chunk
+            )
+
+            # one FIF buffer per BDF data record, as ``mne_edf2fiff`` does
+            for i_start in range(0, n_samples, n_per_record):
+                _write_fif_buffer(
+                    fif_file=fif_file,
+                    data=chunk[:, i_start:i_start + n_per_record]
+                )
+
+        _end_raw_fif(fif_file=fif_file)
+
+    peak_rss = _get_peak_rss()
+
+    if peak_rss is not None:
+        logger.info(
+            "Converted " + bdf_path + " in chunks of " + str(chunk_records) +
+            " records; process peak RSS " + str(peak_rss // 1024 ** 2) +
+            " MB"
+        )
+
+    if manifest_path is not None:
+        record_conversion(
+            manifest_path=manifest_path,
+            output_path=fif_path,
+            input_paths=input_paths,
+            params=params
+        )
+
+
+def batch_convert_bdf_to_fiff(bdf_paths, fif_dir=None, jobs=None, **kwargs):
+    """Convert a set of BDF (or EDF) files to FIF format, in parallel.
+
+    Each file is converted with ``convert_bdf_to_fiff``, using a Polhemus
+    file with the same base name and a '.pos' extension if one exists. A
+    failure in one file is logged and reported, and does not stop the batch.
+    Files that would be written to the same output path (such as 's01.bdf'
+    and 's01.edf') are not converted, and each is reported as failed.
+
+    Parameters
+    ----------
+    bdf_paths: string or list of strings
+        A directory (in which all the '.bdf' and '.edf' files are
+        converted), a glob pattern, or a list of paths.
+    fif_dir: string, optional
+        Directory to write the FIF files to. If not given, each is written
+        alongside its BDF file. The output is named after the input, with a
+        '_raw.fif' suffix.
+    jobs: int, optional
+        Number of worker processes. If not given, it is the number of CPUs.
+        If 1, the files are converted in this process.
+    kwargs:
+        Passed to ``convert_bdf_to_fiff``. If ``manifest_path`` is among
+        them, the manifest is checked and updated by this process only, so
+        that the workers do not race to write it.
+
+    Returns
+    -------
+    results: list of (bdf_path, fif_path, error) tuples
+        One for each input file, in sorted order of ``bdf_path``. ``error`` is
+        ``None`` if the conversion succeeded (or was up to date), and the
+        formatted exception otherwise.
+
+    """
+
+    manifest_path = kwargs.pop("manifest_path", None)
+
+    params = {"converter": "convert_bdf_to_fiff"}
+
+    if isinstance(bdf_paths, str):
+
+        if os.path.isdir(bdf_paths):
+            bdf_paths = (
+                glob.glob(os.path.join(bdf_paths, "*.bdf")) +
+                glob.glob(os.path.join(bdf_paths, "*.edf"))
+            )
+        else:
+            bdf_paths = glob.glob(bdf_paths)
+
+    alias_path = kwargs.get("alias_path")
+
+    jobs_args = []
+
+    for bdf_path in sorted(bdf_paths):
+
+        (bdf_base, _) = os.path.splitext(bdf_path)
+
+        pos_path = bdf_base + ".pos"
+
+        if not os.path.exists(pos_path):
+            pos_path = None
+
+        if fif_dir is not None:
+            bdf_base = os.path.join(fif_dir, os.path.basename(bdf_base))
+
+        jobs_args.append((bdf_path, bdf_base + "_raw.fif", pos_path))
+
+    # inputs that share an output path (such as 's01.bdf' and 's01.edf' in
+    # one directory) would race to write it, so none of them are converted
+    bdf_paths_by_output = {}
+
+    for (bdf_path, fif_path, _) in jobs_args:
+        bdf_paths_by_output.setdefault(os.path.abspath(fif_path), []).append(
+            bdf_path
+        )
+
+    clashes = [
+        (
+            bdf_path,
+            fif_path,
+            "Output path " + fif_path + " is shared by " +
+            ", ".join(bdf_paths_by_output[os.path.abspath(fif_path)])
+        )
+        for (bdf_path, fif_path, _) in jobs_args
+        if len(bdf_paths_by_output[os.path.abspath(fif_path)]) > 1
+    ]
+
+    for (bdf_path, _, error) in clashes:
+        logger.error("Failed to convert " + bdf_path + ":\n" + error)
+
+    jobs_args = [
+        (bdf_path, fif_path, pos_path)
+        for (bdf_path, fif_path, pos_path) in jobs_args
+        if len(bdf_paths_by_output[os.path.abspath(fif_path)]) == 1
+    ]
+
+    if manifest_path is not None:
+
+        manifest = _load_manifest(manifest_path=manifest_path)
+
+        refreshed = []
+
+        current = [
+            _is_entry_current(
+                entry=manifest.get(os.path.abspath(fif_path)),
+                output_path=fif_path,
+                input_paths=[
+                    input_path
+                    for input_path in [bdf_path, pos_path, alias_path]
+                    if input_path is not None
+                ],
+                params=params,
+                refreshed=refreshed
+            )
+            for (bdf_path, fif_path, pos_path) in jobs_args
+        ]
+
+        if refreshed:
+            _save_manifest(manifest_path=manifest_path, manifest=manifest)
 
     else:
 
-        hpts_path = None
+        current = [False] * len(jobs_args)
 
-    # now to convert
-    cmd = [
-        "mne_edf2fiff",
-        "--edf", bdf_path,
-        "--fif", fif_path
+    results = [
+        (bdf_path, fif_path, None)
+        for ((bdf_path, fif_path, _), is_current) in zip(jobs_args, current)
+        if is_current
     ]
 
-    if hpts_path is not None:
-        cmd.extend(
-            [
-                "--hpts", hpts_path
-            ]
+    for (bdf_path, _, _) in results:
+        logger.info(bdf_path + " is up to date; skipping")
+
+    results += clashes
+
+    jobs_args = [
+        job_args
+        for (job_args, is_current) in zip(jobs_args, current)
+        if not is_current
+    ]
+
+    if not jobs_args:
+
+        errors = []
+
+    elif jobs == 1:
+
+        errors = [
+            _convert_bdf_job(bdf_path, fif_path, pos_path, kwargs)
+            for (bdf_path, fif_path, pos_path) in jobs_args
+        ]
+
+    else:
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+
+            errors = list(
+                executor.map(
+                    _convert_bdf_job,
+                    *zip(*jobs_args),
+                    [kwargs] * len(jobs_args)
+                )
+            )
+
+    conversions = []
+
+    for ((bdf_path, fif_path, pos_path), error) in zip(jobs_args, errors):
+
+        if error is None:
+
+            logger.info("Converted " + bdf_path + " to " + fif_path)
+
+            conversions.append(
+                (
+                    fif_path,
+                    [
+                        input_path
+                        for input_path in [bdf_path, pos_path, alias_path]
+                        if input_path is not None
+                    ],
+                    params
+                )
+            )
+
+        else:
+            logger.error("Failed to convert " + bdf_path + ":\n" + error)
+
+        results.append((bdf_path, fif_path, error))
+
+    if manifest_path is not None and conversions:
+        _record_conversions(
+            manifest_path=manifest_path, conversions=conversions
+        )
+
+    results.sort()
+
+    n_failed = sum(error is not None for (_, _, error) in results)
+
+    logger.info(
+        "Converted " + str(len(results) - n_failed) + " of " +
+        str(len(results)) + " BDF files"
+    )
+
+    return results
+
+
+def _convert_bdf_job(bdf_path, fif_path, pos_path, kwargs):
+    "Run a single conversion, returning any error as a string."
+
+    try:
+        convert_bdf_to_fiff(
+            bdf_path=bdf_path, fif_path=fif_path, pos_path=pos_path, **kwargs
         )
+    except Exception:
+        return traceback.format_exc()
 
-    runcmd.run_cmd(" ".join(cmd))
+    return None
 
-    # now to fix the channel info
-    fix_channel_types(fif_path=fif_path)
 
+def fix_channel_types(fif_path, alias_path=None, dry_run=False):
+    """Assign channels in an existing FIF file to the correct type, which is
+    lost when converting from BDF format with ``mne_edf2fiff``. Files written
+    by ``convert_bdf_to_fiff`` already have the correct types.
 
-def fix_channel_types(fif_path, alias_path=None):
-    """Assign channels in a FIF file to the correct type, which is lost when
-    converting from BDF format.
+    The channel information tags are patched in place through a memory map,
+    so only a few bytes per channel are written regardless of the length of
+    the recording.
 
     Parameters
     ----------
@@ -78,194 +551,3108 @@ def fix_channel_types(fif_path, alias_path=None):
     alias_path: string, optional
         Path to the channel change information file. If not given, a standard
         based on the 64-channel fix at UNSW is applied.
+    dry_run: bool, optional
+        If ``True``, only report what would be changed.
+
+    Returns
+    -------
+    changes: list of (name, new_name, kind, new_kind) tuples
+        The channels that were (or would be) changed.
 
     """
 
     if alias_path is None:
+        aliases = _get_default_channel_aliases()
+    else:
+        aliases = _read_channel_aliases(alias_path=alias_path)
+
+    fif_map = np.memmap(
+        fif_path, dtype=np.uint8, mode="r" if dry_run else "r+"
+    )
+
+    changes = []
+
+    for (tag_pos, kind, _, _) in _iter_fif_tags(fif_map=fif_map):
+
+        if kind != _FIFF_CH_INFO:
+            continue
+
+        ch_info = fif_map[
+            tag_pos + 16:tag_pos + 16 + _FIF_CH_INFO_DTYPE.itemsize
+        ].view(_FIF_CH_INFO_DTYPE)
+
+        ch_name = ch_info["ch_name"][0].decode("latin-1")
+
+        if ch_name not in aliases:
+            continue
+
+        ch_kind = int(ch_info["kind"][0])
+
+        (new_name, new_kind) = aliases[ch_name]
+
+        if new_kind is None:
+            new_kind = ch_kind
+
+        if (new_name, new_kind) == (ch_name, ch_kind):
+            continue
+
+        changes.append((ch_name, new_name, ch_kind, new_kind))
+
+        logger.info(
+            ("Would change " if dry_run else "Changing ") + ch_name +
+            " (kind " + str(ch_kind) + ") to " + new_name +
+            " (kind " + str(new_kind) + ")"
+        )
+
+        if not dry_run:
+            ch_info["kind"] = new_kind
+            ch_info["ch_name"] = new_name[:15].encode("latin-1")
+
+    if not dry_run:
+        fif_map.flush()
+
+    del fif_map
+
+    return changes
+
+
+def _iter_fif_tags(fif_map):
+    """Walk the tags of a (memory-mapped) FIF file, yielding the position,
+    kind, type, and data size of each; the tag data follow the 16-byte tag
+    header."""
+
+    tag_pos = 0
+
+    while 0 <= tag_pos <= len(fif_map) - 16:
+
+        (kind, fiff_type, size, next_pos) = (
+            int(value)
+            for value in fif_map[tag_pos:tag_pos + 16].view(">i4")
+        )
+
+        yield (tag_pos, kind, fiff_type, size)
+
+        # a 'next' of zero means the next tag follows on directly, and of -1
+        # means that this is the last tag
+        if next_pos == 0:
+            tag_pos += 16 + size
+        else:
+            tag_pos = next_pos
+
+
+def _get_default_channel_aliases():
+    """The channel types for the standard 64-channel setup at UNSW, as a dict
+    of channel name to (new name, FIF channel kind)."""
+
+    eog_chans = ["EXG" + str(chan) for chan in [1, 2, 5]]
+    misc_chans = ["EXG" + str(chan) for chan in [3, 4, 6, 7, 8]]
+
+    misc_chans.extend(["Erg" + str(chan) for chan in [1, 2]])
+    misc_chans.extend(["GSR" + str(chan) for chan in [1, 2]])
+    misc_chans.extend(["Resp", "Plet", "Temp"])
+
+    aliases = {
+        chan_name: (chan_name, _FIFFV_EOG_CH)
+        for chan_name in eog_chans
+    }
+
+    aliases.update(
+        {
+            chan_name: (chan_name, _FIFFV_MISC_CH)
+            for chan_name in misc_chans
+        }
+    )
+
+    return aliases
+
+
+def _read_channel_aliases(alias_path):
+    """Read an MNE channel alias file, with 'name:new_name[:kind]' lines, as
+    a dict of channel name to (new name, FIF channel kind or ``None``)."""
+
+    aliases = {}
+
+    with open(alias_path, "r") as alias_file:
+
+        for alias_line in alias_file:
+
+            alias_info = alias_line.strip().split(":")
+
+            if alias_info == [""]:
+                continue
+
+            if len(alias_info) == 3:
+                kind = int(alias_info[2])
+            else:
+                kind = None
+
+            aliases[alias_info[0]] = (alias_info[1], kind)
+
+    return aliases
 
-        eog_chans = ["EXG" + str(chan) for chan in [1, 2, 5]]
-        misc_chans = ["EXG" + str(chan) for chan in [3, 4, 6, 7, 8]]
 
-        misc_chans.extend(["Erg" + str(chan) for chan in [1, 2]])
-        misc_chans.extend(["GSR" + str(chan) for chan in [1, 2]])
-        misc_chans.extend(["Resp", "Plet", "Temp"])
+def read_bdf_header(bdf_path):
+    """Read the header of a BioSemi BDF file, or of an EDF/EDF+ file.
 
-        eog_code = 202
-        misc_code = 502
+    The two formats share a layout, and differ only in the width of the
+    samples (3 bytes for BDF and 2 for EDF). The annotation signals of an
+    EDF+ file ("EDF Annotations") are not data signals, so are left out of
+    the per-signal fields; they can be read with ``read_edf_annotations``.
 
-        chan_out = [
-            ":".join([chan_name] * 2 + [str(eog_code)])
-            for chan_name in eog_chans
+    Parameters
+    ----------
+    bdf_path: string
+        Path to the BDF or EDF file.
+
+    Returns
+    -------
+    header: dict
+        The fixed header fields ("subject", "recording", "start_time",
+        "header_bytes", "reserved", "n_records", "record_duration",
+        "n_signals"), the per-signal fields ("labels", "transducers",
+        "physical_dims", "prefilters" as lists of strings and "physical_min",
+        "physical_max", "digital_min", "digital_max", "samples_per_record" as
+        arrays), and the layout of the data records ("format", one of "BDF",
+        "EDF" and "EDF+"; "sample_bytes"; "record_bytes"; and the byte offsets
+        within a record of each data signal, "signal_offsets", and of each
+        annotation signal, "annotation_offsets", with their sizes,
+        "annotation_bytes").
+
+    """
+
+    with open(bdf_path, "rb") as bdf_file:
+
+        fixed = bdf_file.read(256)
+
+        if len(fixed) == 256 and fixed[:8] == b"\xffBIOSEMI":
+            (file_format, sample_bytes) = ("BDF", 3)
+        elif len(fixed) == 256 and fixed[:8] == b"0       ":
+            (file_format, sample_bytes) = ("EDF", 2)
+        else:
+            raise ValueError(bdf_path + " is not a BDF or EDF file")
+
+        n_signals = int(fixed[252:256])
+
+        signals = bdf_file.read(256 * n_signals)
+
+    if len(signals) != 256 * n_signals:
+        raise ValueError("Header of " + bdf_path + " is truncated")
+
+    def as_str(raw):
+        return raw.decode("latin-1").strip()
+
+    (day, month, year) = map(int, as_str(fixed[168:176]).split("."))
+    (hour, minute, second) = map(int, as_str(fixed[176:184]).split("."))
+
+    # two-digit years, with the 1985 clipping date from the EDF spec
+    year += 1900 if year >= 85 else 2000
+
+    header = {
+        "subject": as_str(fixed[8:88]),
+        "recording": as_str(fixed[88:168]),
+        "start_time": datetime.datetime(
+            year, month, day, hour, minute, second
+        ),
+        "header_bytes": int(fixed[184:192]),
+        "reserved": as_str(fixed[192:236]),
+        "n_records": int(fixed[236:244]),
+        "record_duration": float(fixed[244:252]),
+        "n_signals": n_signals
+    }
+
+    # the signal fields are stored field-by-field rather than signal-by-signal
+    fields = [
+        ("labels", 16, as_str),
+        ("transducers", 80, as_str),
+        ("physical_dims", 8, as_str),
+        ("physical_min", 8, float),
+        ("physical_max", 8, float),
+        ("digital_min", 8, int),
+        ("digital_max", 8, int),
+        ("prefilters", 80, as_str),
+        ("samples_per_record", 8, int),
+        ("signal_reserved", 32, as_str)
+    ]
+
+    offset = 0
+
+    for (field_name, field_width, field_type) in fields:
+
+        values = [
+            field_type(signals[i_start:i_start + field_width])
+            for i_start in range(
+                offset, offset + field_width * n_signals, field_width
+            )
         ]
 
-        chan_out.extend(
-            [
-                ":".join([chan_name] * 2 + [str(misc_code)])
-                for chan_name in misc_chans
+        if field_type is not as_str:
+            values = np.array(values)
+
+        header[field_name] = values
+
+        offset += field_width * n_signals
+
+    if file_format == "EDF" and header["reserved"].startswith("EDF+"):
+        file_format = "EDF+"
+
+    header["format"] = file_format
+    header["sample_bytes"] = sample_bytes
+
+    signal_bytes = header["samples_per_record"] * sample_bytes
+    signal_offsets = np.cumsum(signal_bytes) - signal_bytes
+
+    header["record_bytes"] = int(np.sum(signal_bytes))
+
+    is_annotation = np.array(
+        [label == "EDF Annotations" for label in header["labels"]],
+        dtype=bool
+    )
+
+    header["annotation_offsets"] = signal_offsets[is_annotation]
+    header["annotation_bytes"] = signal_bytes[is_annotation]
+
+    header["signal_offsets"] = signal_offsets[~is_annotation]
+
+    header["n_signals"] = int(np.sum(~is_annotation))
+
+    for (field_name, _, field_type) in fields:
+
+        if field_type is as_str:
+            header[field_name] = [
+                value
+                for (value, is_annotation_signal) in zip(
+                    header[field_name], is_annotation
+                )
+                if not is_annotation_signal
             ]
+        else:
+            header[field_name] = header[field_name][~is_annotation]
+
+    # the number of records is -1 if the recording was not closed properly
+    if header["n_records"] < 0:
+
+        header["n_records"] = int(
+            (os.path.getsize(bdf_path) - header["header_bytes"]) //
+            header["record_bytes"]
         )
 
-        alias_path = tempfile.NamedTemporaryFile(delete=False)
+    return header
 
-        alias_path.file.write("\n".join(chan_out))
 
-        alias_path.close()
+def read_edf_annotations(edf_path):
+    """Read the annotations of an EDF+ file.
 
-        alias_path = alias_path.name
+    The time-stamped annotation lists of all the data records are split
+    apart in one go; the time-keeping entry that starts each record, which
+    has no text, is skipped.
 
-    cmd = [
-        "mne_rename_channels",
-        "--fif", fif_path,
-        "--alias", alias_path
-    ]
+    Parameters
+    ----------
+    edf_path: string
+        Path to the EDF+ file.
+
+    Returns
+    -------
+    onsets, durations: float arrays, shape (n_annotations,)
+        Start and duration of each annotation, in seconds from the start of
+        the recording. Durations that are not given are 0.
+    descriptions: list of strings
 
-    runcmd.run_cmd(" ".join(cmd))
+    """
 
+    header = read_bdf_header(bdf_path=edf_path)
 
-def convert_fastrak_to_hpts(pos_path, hpts_path, overwrite=True):
-    """Convert a set of electrode locations recorded with a Polhemus FASTRAK
-    (and saved in '.pos' format) to the 'hpts' format that can be used with the
-    MNE suite.
+    records = _map_bdf_records(bdf_path=edf_path, header=header)
+
+    # the annotation bytes of each record, record by record
+    text = np.concatenate(
+        [records[:, :0]] +
+        [
+            records[:, offset:offset + n_bytes]
+            for (offset, n_bytes) in zip(
+                header["annotation_offsets"], header["annotation_bytes"]
+            )
+        ],
+        axis=1
+    ).tobytes()
+
+    onsets = []
+    durations = []
+    descriptions = []
+
+    # each list is '+onset[\x15duration]\x14text\x14[text\x14...]\x00'
+    for annotation_list in text.split(b"\x00"):
+
+        fields = annotation_list.split(b"\x14")
+
+        if len(fields) < 3:
+            continue
+
+        (onset, _, duration) = fields[0].partition(b"\x15")
+
+        for description in fields[1:-1]:
+
+            if not description:
+                continue
+
+            onsets.append(float(onset))
+            durations.append(float(duration) if duration else 0.0)
+            descriptions.append(_decode_text(raw=description))
+
+    order = np.argsort(onsets, kind="stable")
+
+    return (
+        np.array(onsets, dtype=float)[order],
+        np.array(durations, dtype=float)[order],
+        [descriptions[i_annotation] for i_annotation in order]
+    )
+
+
+class BioSemiEEG(object):
+    """Lazy access to a BioSemi BDF (or EDF/EDF+) recording.
+
+    The data records are memory-mapped, and nothing is decoded until the
+    object is indexed. Indexing with ``[channels, samples]`` (or just
+    ``[channels]``), where ``samples`` is an integer or a slice, decodes only
+    the selected channels of the records that cover the samples, and returns
+    their physical values, with voltages in volts.
 
     Parameters
     ----------
-    pos_path: string
-        Path to the Polhemus 'pos' file, as written by BrainStorm.
-    hpts_path: string
-        Path to the 'hpts' file to write.
-    overwrite: bool, optional
-        Whether to overwrite ``hpts_path``, if it exists.
+    bdf_path: string
+        Path to the BDF file.
+
+    Attributes
+    ----------
+    header: dict
+        The file header, as returned by ``read_bdf_header``.
+    ch_names: list of strings
+    units: list of strings
+        Physical dimension of each channel, as given in the file.
+    gains, offsets: float arrays, shape (n_channels,)
+        Calibration from digital to physical values.
+    sfreq: float
+        Sampling rate, in Hz.
+    n_channels, n_samples: int
+    n_per_record: int
+        Number of samples of each channel in a data record.
+    records: uint8 array, shape (n_records, n_record_bytes)
+        The data records, as a memory map.
 
     """
 
-    if not overwrite and os.path.exists(hpts_path):
-        raise ValueError("Output path " + hpts_path + " already exists")
+    def __init__(self, bdf_path):
 
-    header = "# Converted from " + pos_path + " to " + hpts_path + "\n"
-    header += "# " + str(datetime.datetime.now()) + "\n"
+        self.header = read_bdf_header(bdf_path=bdf_path)
 
-    data = ""
+        _check_bdf_sampling(header=self.header)
 
-    with open(pos_path, "r") as pos_file:
-        raw_data = pos_file.readlines()
+        self.n_per_record = int(self.header["samples_per_record"][0])
 
-    i_eeg = 1
-    i_extra = 1
+        self.ch_names = list(self.header["labels"])
+        self.units = list(self.header["physical_dims"])
 
-    # ignore the first
-    for pos_data in raw_data[1:]:
+        (self.gains, self.offsets) = _get_bdf_calibration(header=self.header)
 
-        pos_info = pos_data.strip().split("\t")
+        self.sfreq = self.n_per_record / self.header["record_duration"]
 
-        if len(pos_info) == 4:
+        self.n_channels = self.header["n_signals"]
+        self.n_samples = self.header["n_records"] * self.n_per_record
 
-            category = "cardinal"
+        self.records = _map_bdf_records(bdf_path=bdf_path, header=self.header)
 
-            pos_id = pos_info[0]
+    def __len__(self):
+        return self.n_samples
 
-            if pos_id == "NA":
-                identifier = "2"
-            elif pos_id == "LPA":
-                identifier = "1"
-            elif pos_id == "RPA":
-                identifier = "3"
+    def __getitem__(self, key):
 
-            (pos_x, pos_y, pos_z) = pos_info[1:]
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
 
-        elif len(pos_info) == 5:
+        (channel_key, sample_key) = key
 
-            (pos_id, pos_name, pos_x, pos_y, pos_z) = pos_info
+        i_chans = np.arange(self.n_channels)[channel_key]
 
-            # if the name is empty, must be shape points
-            if pos_name == "":
+        if isinstance(sample_key, slice):
+            samples = range(*sample_key.indices(self.n_samples))
+        elif isinstance(sample_key, (int, np.integer)):
+            if sample_key < 0:
+                sample_key += self.n_samples
+            if not 0 <= sample_key < self.n_samples:
+                raise IndexError("Sample index out of range")
+            samples = range(sample_key, sample_key + 1)
+        else:
+            raise ValueError("Samples must be selected by integer or slice")
 
-                category = "extra"
+        values = np.zeros((np.size(i_chans), len(samples)))
 
-                identifier = str(i_extra)
+        if len(samples):
 
-                i_extra += 1
+            i_first = min(samples[0], samples[-1])
+            i_last = max(samples[0], samples[-1])
 
-            # otherwise, must be EEG
-            else:
+            # the records that cover the samples
+            i_record = i_first // self.n_per_record
+            n_records = i_last // self.n_per_record - i_record + 1
 
-                category = "eeg"
+            block = np.empty(
+                (np.size(i_chans), n_records * self.n_per_record)
+            )
 
-                identifier = str(i_eeg)
+            _decode_bdf_records(
+                records=self.records[i_record:i_record + n_records],
+                header=self.header,
+                out=block,
+                signals=np.atleast_1d(i_chans)
+            )
 
-                i_eeg += 1
+            i_block = (
+                np.arange(len(samples)) * samples.step +
+                samples[0] - i_record * self.n_per_record
+            )
 
-        # position is given in cm, so needs to be converted to mm
-        [pos_x, pos_y, pos_z] = [
-            str(float(pos) * 10)
-            for pos in [pos_x, pos_y, pos_z]
-        ]
+            values[:] = block[:, i_block]
 
-        data += " ".join([category, identifier, pos_x, pos_y, pos_z]) + "\n"
+        if np.ndim(i_chans) == 0:
+            values = values[0]
 
-    with open(hpts_path, "w") as hpts_file:
-        hpts_file.write(header + data)
+        if not isinstance(sample_key, slice):
+            values = values[..., 0]
 
+        return values
 
-def convert_brain_vision_to_csv(
-    vhdr_path,
-    dat_path,
-    csv_path,
-    start_ms=-200.0
-):
+    def get_data(self, channels=None, tmin_ms=None, tmax_ms=None):
+        """Get the physical values of a set of channels within a time window.
 
-    eeg_config = configparser.ConfigParser()
+        Only the data records that cover the window are decoded.
 
-    with open(vhdr_path, "r") as handle:
+        Parameters
+        ----------
+        channels: list of strings, optional
+            Names of the channels to get, in order. If not given, all
+            channels are returned.
+        tmin_ms, tmax_ms: float, optional
+            Times, in ms relative to the first sample, of the first and last
+            samples to get. If not given, the window extends to the start and
+            end of the recording.
 
-        # skip the first line
-        handle.readline()
+        Returns
+        -------
+        data: array, shape (n_selected_channels, n_window_samples)
 
-        eeg_config.readfp(handle)
+        """
 
-        sample_interval = float(
-            eeg_config.get("Common Infos", "SamplingInterval")
+        if channels is None:
+            i_chans = slice(None)
+        else:
+            i_chans = _get_channel_indices(
+                ch_names=self.ch_names, channels=channels
+            )
+
+        (i_start, i_stop) = _get_time_window(
+            n_samples=self.n_samples,
+            start_ms=0.0,
+            step_ms=1000.0 / self.sfreq,
+            tmin_ms=tmin_ms,
+            tmax_ms=tmax_ms
         )
 
-        sample_interval = 1000000.0 / sample_interval
+        return self[i_chans, i_start:i_stop]
 
-        n_samples = int(eeg_config.get("Common Infos", "DataPoints"))
-        n_in = int(eeg_config.get("Common Infos", "AveragedSegments"))
-        n_channels = int(eeg_config.get("Common Infos", "NumberOfChannels"))
 
-    # time, in ms
-    t = np.arange(n_samples) / sample_interval * 1000.0
+def read_bdf(bdf_path, threads=None, dtype=None):
+    """Read the samples from a BioSemi BDF file, or an EDF/EDF+ file.
 
-    # convert to ERP time
-    t += start_ms
+    The file is memory-mapped, so only the bytes of each signal are touched
+    while it is being decoded. The data records are split into blocks that
+    are decoded by a pool of threads, each straight into its slice of the
+    output; the decoding is done by NumPy operations that release the GIL,
+    so the threads run in parallel.
 
-    data = np.full((n_samples, n_channels + 1), np.nan)
+    Parameters
+    ----------
+    bdf_path: string
+        Path to the BDF file.
+    threads: int, optional
+        Number of decoding threads. If not given, it is the number of CPUs.
+    dtype: numpy floating point dtype, optional
+        If given, the physical values are returned, as this type, with
+        voltages in volts; they are calibrated as part of the decoding, so
+        float32 needs half the memory of float64 and no more temporaries.
+
+    Returns
+    -------
+    header: dict
+        The file header, as returned by ``read_bdf_header``.
+    data: array, shape (n_signals, n_samples)
+        The digital (uncalibrated) sample values, as int32, or the physical
+        values if ``dtype`` is given.
 
-    data[:, 0] = t
+    """
 
-    header = ["time(ms)"]
+    if dtype is None:
+        dtype = np.dtype("<i4")
+    elif np.dtype(dtype).kind != "f":
+        raise ValueError("dtype must be a floating point type")
 
-    with open(dat_path, "r") as handle:
+    header = read_bdf_header(bdf_path=bdf_path)
 
-        raw = handle.readlines()
+    _check_bdf_sampling(header=header)
 
-        for (i_chan, row) in enumerate(raw, 1):
+    records = _map_bdf_records(bdf_path=bdf_path, header=header)
 
-            bits = " ".join(row.strip().split()).split()
+    n_records = header["n_records"]
+    n_per_record = header["samples_per_record"][0]
 
-            channel = bits[0]
-            header.append(channel)
+    data = np.empty(
+        (header["n_signals"], n_records * n_per_record), dtype=dtype
+    )
 
-            data[:, i_chan] = np.array(list(map(float, bits[1:])))
+    if threads is None:
+        threads = os.cpu_count() or 1
 
-    assert np.sum(np.isnan(data)) == 0
+    def decode_block(i_start, i_stop):
+        _decode_bdf_records(
+            records=records[i_start:i_stop],
+            header=header,
+            out=data[:, i_start * n_per_record:i_stop * n_per_record]
+        )
 
-    np.savetxt(
-        csv_path,
-        data,
-        delimiter=",",
-        header=",".join(header),
-        fmt="%.12f",
-        comments=""
-    )
+    if threads == 1:
 
-    return data
+        decode_block(0, n_records)
+
+    else:
+
+        # a few blocks per thread, to even out the load
+        bounds = np.linspace(
+            0, n_records, min(n_records, 4 * threads) + 1
+        ).astype(int)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads
+        ) as executor:
+            list(executor.map(decode_block, bounds[:-1], bounds[1:]))
+
+    return (header, data)
+
+
+def find_bdf_events(
+    bdf_path, mask=0xFFFF, channel="Status", chunk_records=None
+):
+    """Find the trigger events in the Status channel of a BioSemi BDF file.
+
+    Only the Status channel is decoded, a chunk of data records at a time,
+    and the chunks are passed through a ``TriggerDecoder``.
+
+    Parameters
+    ----------
+    bdf_path: string
+        Path to the BDF file.
+    mask: int, optional
+        Bits of the Status values that hold the triggers; by default, the
+        low 16 bits, leaving out the BioSemi status flags.
+    channel: string, optional
+        Name of the trigger channel.
+    chunk_records: int, optional
+        Number of data records to decode at a time. If not given, as many as
+        fit in 256 MB.
+
+    Returns
+    -------
+    samples, values, offsets: int arrays, shape (n_events,)
+        Onset sample, trigger value and offset sample (the sample after the
+        last with that value) of each event.
+
+    """
+
+    header = read_bdf_header(bdf_path=bdf_path)
+
+    _check_bdf_sampling(header=header)
+
+    if channel not in header["labels"]:
+        raise ValueError("No " + channel + " channel in " + bdf_path)
+
+    i_status = header["labels"].index(channel)
+
+    records = _map_bdf_records(bdf_path=bdf_path, header=header)
+
+    n_records = header["n_records"]
+    n_per_record = header["samples_per_record"][0]
+
+    if chunk_records is None:
+        chunk_records = _DEFAULT_MAX_MEMORY // (n_per_record * 4)
+
+    chunk_records = max(1, min(chunk_records, n_records))
+
+    status = np.empty((1, chunk_records * n_per_record), dtype="<i4")
+
+    decoder = TriggerDecoder(mask=mask)
+
+    events = []
+
+    for i_record in range(0, n_records, chunk_records):
+
+        n_chunk = min(chunk_records, n_records - i_record)
+
+        chunk = status[:, :n_chunk * n_per_record]
+
+        _decode_bdf_records(
+            records=records[i_record:i_record + n_chunk],
+            header=header,
+            out=chunk,
+            signals=[i_status]
+        )
+
+        events.append(decoder.update(status=chunk[0]))
+
+    events.append(decoder.finish())
+
+    return tuple(
+        np.concatenate([chunk_events[i_array] for chunk_events in events])
+        for i_array in range(3)
+    )
+
+
+class TriggerDecoder(object):
+    """Find trigger events in a trigger channel, fed to it in consecutive
+    chunks.
+
+    An event is a run of samples with the same non-zero (masked) value. The
+    changes of value in each chunk are found with a single ``np.diff``, and
+    the value of the last sample, and any event still running at the end of
+    the chunk, are carried over to the next.
+
+    Parameters
+    ----------
+    mask: int, optional
+        Bits of the channel values that hold the triggers.
+
+    """
+
+    def __init__(self, mask=0xFFFF):
+
+        self.mask = mask
+
+        # samples seen so far, the (masked) value of the last of them, and
+        # the onset and value of the event that is still running, if any
+        self._n_samples = 0
+        self._previous = 0
+        self._running = None
+
+    def update(self, status):
+        """Find the events that end within a chunk of samples.
+
+        Parameters
+        ----------
+        status: int array, shape (n_chunk_samples,)
+            The next samples of the trigger channel.
+
+        Returns
+        -------
+        samples, values, offsets: int arrays, shape (n_events,)
+            Onset sample, trigger value and offset sample of each event that
+            ended within the chunk, with samples counted from the start of
+            the first chunk.
+
+        """
+
+        values = np.bitwise_and(status, self.mask)
+
+        # indices of the samples whose value differs from the one before
+        changes = np.flatnonzero(np.diff(values))
+        changes += 1
+
+        if len(values) and values[0] != self._previous:
+            changes = np.concatenate([[0], changes])
+
+        change_values = values[changes]
+        change_samples = changes + self._n_samples
+
+        # every change of value ends the event that is running, and starts
+        # a new one unless the value is zero
+        i_onsets = np.flatnonzero(change_values)
+
+        has_ended = i_onsets < len(changes) - 1
+
+        samples = change_samples[i_onsets[has_ended]]
+        values_out = change_values[i_onsets[has_ended]]
+        offsets = change_samples[i_onsets[has_ended] + 1]
+
+        if len(changes):
+
+            if self._running is not None:
+                samples = np.concatenate([[self._running[0]], samples])
+                values_out = np.concatenate([[self._running[1]], values_out])
+                offsets = np.concatenate([[change_samples[0]], offsets])
+
+            if change_values[-1] != 0:
+                self._running = (change_samples[-1], change_values[-1])
+            else:
+                self._running = None
+
+        if len(values):
+            self._previous = values[-1]
+
+        self._n_samples += len(values)
+
+        return (
+            samples.astype(np.int64),
+            values_out.astype(np.int64),
+            offsets.astype(np.int64)
+        )
+
+    def finish(self):
+        """End the stream, returning the event still running at its end (if
+        any) in the same form as ``update``, with its offset at the end."""
+
+        if self._running is None:
+            events = ([], [], [])
+        else:
+            events = (
+                [self._running[0]], [self._running[1]], [self._n_samples]
+            )
+
+        self._running = None
+
+        return tuple(np.array(array, dtype=np.int64) for array in events)
+
+
+def _check_bdf_sampling(header):
+    "Check that all the signals in a BDF file have the same sampling rate."
+
+    samples_per_record = header["samples_per_record"]
+
+    if np.any(samples_per_record != samples_per_record[0]):
+        raise ValueError(
+            "Signals with different sampling rates are not supported"
+        )
+
+
+def _decode_bdf_records(records, header, out, signals=None):
+    """Decode a (n_records, n_bytes) block of BDF data records into an
+    (n_signals, n_records * n_per_record) array, or just the rows of the
+    given signals into an (n_selected_signals, ...) one.
+
+    An int32 ``out`` gets the digital values. A floating point one gets the
+    physical values (with voltages in volts), calibrated signal by signal as
+    they are decoded, in double precision, so that there is never more than a
+    row of temporaries."""
+
+    n_records = records.shape[0]
+    n_per_record = header["samples_per_record"][0]
+    n_bytes = n_per_record * header["sample_bytes"]
+
+    if signals is None:
+        signals = range(header["n_signals"])
+
+    is_digital = out.dtype == np.dtype("<i4")
+
+    if not is_digital:
+
+        (gain, offset) = _get_bdf_calibration(header=header)
+
+        digital = np.empty((n_records, n_per_record), dtype="<i4")
+        physical = np.empty((n_records, n_per_record))
+
+    for (i_out, i_signal) in enumerate(signals):
+
+        i_start = header["signal_offsets"][i_signal]
+
+        # (n_records, n_bytes) view onto this signal's bytes
+        raw = records[:, i_start:i_start + n_bytes]
+
+        out_signal = out[i_out, :].reshape(n_records, n_per_record)
+
+        if is_digital:
+            _decode_samples(raw, header=header, out=out_signal)
+            continue
+
+        _decode_samples(raw, header=header, out=digital)
+
+        np.multiply(digital, gain[i_signal], out=physical)
+        physical += offset[i_signal]
+
+        out_signal[...] = physical
+
+
+def _decode_samples(raw, header, out):
+    """Decode a (n_records, n_bytes) view of one signal's samples into an
+    (n_records, n_per_record) int32 array."""
+
+    if header["sample_bytes"] == 3:
+        decode_int24(raw.reshape(out.shape + (3,)), out=out)
+    else:
+        out[...] = raw.view("<i2")
+
+
+def _map_bdf_records(bdf_path, header):
+    "Memory-map the data records of a BDF file as (n_records, n_bytes)."
+
+    return np.memmap(
+        bdf_path,
+        dtype=np.uint8,
+        mode="r",
+        offset=header["header_bytes"],
+        shape=(header["n_records"], header["record_bytes"])
+    )
+
+
+def decode_int24(raw, out=None):
+    """Decode packed little-endian 24-bit two's complement samples.
+
+    The three bytes of each sample are copied into the high bytes of an int32
+    through a strided byte view, and an in-place arithmetic right shift then
+    moves them down and sign-extends them. This is two whole-array operations
+    and needs no intermediate arrays.
+
+    Parameters
+    ----------
+    raw: uint8 array, shape (..., 3)
+        The sample bytes. Can be any (strided) view, such as a slice of a
+        memory-mapped file.
+    out: int32 array, shape (...), optional
+        Array to decode into. If not given, a new array is allocated.
+
+    Returns
+    -------
+    out: int32 array, shape (...)
+        The decoded samples.
+
+    """
+
+    if raw.shape[-1] != 3:
+        raise ValueError("The last axis of the samples must have length 3")
+
+    if out is None:
+        out = np.empty(raw.shape[:-1], dtype="<i4")
+
+    elif out.dtype != np.dtype("<i4") or out.shape != raw.shape[:-1]:
+        raise ValueError(
+            "Output must be little-endian int32 with shape " +
+            str(raw.shape[:-1])
+        )
+
+    # (..., 4) byte view onto the output
+    out_bytes = out[..., np.newaxis].view(np.uint8)
+
+    # whatever is in the lowest byte is shifted out
+    out_bytes[..., 1:] = raw
+
+    np.right_shift(out, 8, out=out)
+
+    return out
+
+
+def _get_bdf_calibration(header):
+    """Get the per-signal gain and offset that take digital BDF values to
+    physical values, with voltages in volts."""
+
+    gain = (
+        (header["physical_max"] - header["physical_min"]) /
+        (header["digital_max"] - header["digital_min"])
+    )
+
+    offset = header["physical_max"] - gain * header["digital_max"]
+
+    scale = np.array(
+        [
+            _VOLTAGE_UNITS.get(physical_dim, 1.0)
+            for physical_dim in header["physical_dims"]
+        ]
+    )
+
+    return (gain * scale, offset * scale)
+
+
+def _get_peak_rss():
+    """Peak resident set size of this process, in bytes, if it can be found.
+    This is the peak over the life of the process, so in a reused worker it
+    can come from an earlier task."""
+
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+
+    return peak_rss
+
+
+def _write_fif_tag(fif_file, kind, fiff_type, data):
+    "Write a single tag, with ``data`` being a big-endian array or bytes."
+
+    data = memoryview(data).cast("B")
+
+    fif_file.write(
+        np.array([kind, fiff_type, len(data), 0], dtype=">i4").tobytes()
+    )
+
+    fif_file.write(data)
+
+
+def _write_fif_int(fif_file, kind, value):
+    "Write an integer (or integer array) tag."
+    _write_fif_tag(fif_file, kind, _FIFFT_INT, np.array(value, dtype=">i4"))
+
+
+def _write_fif_float(fif_file, kind, value):
+    "Write a single-precision float (or float array) tag."
+    _write_fif_tag(
+        fif_file, kind, _FIFFT_FLOAT, np.array(value, dtype=">f4")
+    )
+
+
+def _start_raw_fif(fif_file, header, ch_names, ch_kinds, dig=None):
+    """Write the file identification, measurement info, and the start of the
+    raw data block of a FIF file for the signals described by a BDF header,
+    with the given channel names and kinds.
+
+    ``dig`` is an optional array with dtype ``_FIF_DIG_POINT_DTYPE``.
+
+    """
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    file_id = np.array(
+        [
+            _FIFFC_VERSION,
+            0,
+            0,
+            calendar.timegm(now.timetuple()),
+            now.microsecond
+        ],
+        dtype=">i4"
+    )
+
+    _write_fif_tag(fif_file, _FIFF_FILE_ID, _FIFFT_ID_STRUCT, file_id)
+
+    # no directory and no free list; readers will scan the tags instead
+    _write_fif_int(fif_file, _FIFF_DIR_POINTER, -1)
+    _write_fif_int(fif_file, _FIFF_FREE_LIST, -1)
+
+    _write_fif_int(fif_file, _FIFF_BLOCK_START, _FIFFB_MEAS)
+    _write_fif_int(fif_file, _FIFF_BLOCK_START, _FIFFB_MEAS_INFO)
+
+    sfreq = header["samples_per_record"][0] / header["record_duration"]
+
+    _write_fif_int(fif_file, _FIFF_NCHAN, header["n_signals"])
+    _write_fif_float(fif_file, _FIFF_SFREQ, sfreq)
+    _write_fif_float(fif_file, _FIFF_LOWPASS, sfreq / 2.0)
+    _write_fif_float(fif_file, _FIFF_HIGHPASS, 0.0)
+
+    _write_fif_int(
+        fif_file,
+        _FIFF_MEAS_DATE,
+        [calendar.timegm(header["start_time"].timetuple()), 0]
+    )
+
+    ch_info = np.zeros(header["n_signals"], dtype=_FIF_CH_INFO_DTYPE)
+
+    ch_info["scan_no"] = np.arange(1, header["n_signals"] + 1)
+    ch_info["log_no"] = ch_info["scan_no"]
+    ch_info["kind"] = ch_kinds
+    ch_info["range"] = 1.0
+    ch_info["cal"] = 1.0
+
+    for (i_chan, ch_kind) in enumerate(ch_kinds):
+
+        physical_dim = header["physical_dims"][i_chan]
+
+        if ch_kind == _FIFFV_EEG_CH:
+            ch_info["coil_type"][i_chan] = _FIFFV_COIL_EEG
+        else:
+            ch_info["coil_type"][i_chan] = _FIFFV_COIL_NONE
+
+        if physical_dim in _VOLTAGE_UNITS:
+            ch_info["unit"][i_chan] = _FIFF_UNIT_V
+        else:
+            ch_info["unit"][i_chan] = _FIFF_UNIT_NONE
+
+        ch_info["ch_name"][i_chan] = ch_names[i_chan][:15].encode("latin-1")
+
+    for ch_record in ch_info:
+        _write_fif_tag(
+            fif_file, _FIFF_CH_INFO, _FIFFT_CH_INFO_STRUCT, ch_record.tobytes()
+        )
+
+    if dig is not None:
+
+        _write_fif_int(fif_file, _FIFF_BLOCK_START, _FIFFB_ISOTRAK)
+
+        for dig_point in dig:
+            _write_fif_tag(
+                fif_file,
+                _FIFF_DIG_POINT,
+                _FIFFT_DIG_POINT_STRUCT,
+                dig_point.tobytes()
+            )
+
+        _write_fif_int(fif_file, _FIFF_BLOCK_END, _FIFFB_ISOTRAK)
+
+    _write_fif_int(fif_file, _FIFF_BLOCK_END, _FIFFB_MEAS_INFO)
+    _write_fif_int(fif_file, _FIFF_BLOCK_START, _FIFFB_RAW_DATA)
+
+
+def _write_fif_buffer(fif_file, data):
+    "Write a (n_channels, n_samples) block of physical values to a FIF file."
+
+    _write_fif_tag(
+        fif_file,
+        _FIFF_DATA_BUFFER,
+        _FIFFT_FLOAT,
+        np.ascontiguousarray(data.T, dtype=">f4")
+    )
+
+
+def _end_raw_fif(fif_file):
+    "Close the raw data and measurement blocks, and the file itself."
+
+    _write_fif_int(fif_file, _FIFF_BLOCK_END, _FIFFB_RAW_DATA)
+    _write_fif_int(fif_file, _FIFF_BLOCK_END, _FIFFB_MEAS)
+
+    # a final NOP tag, with a 'next' of -1, marks the end of the file
+    fif_file.write(
+        np.array([_FIFF_NOP, _FIFFT_VOID, 0, -1], dtype=">i4").tobytes()
+    )
+
+
+def convert_fastrak_to_hpts(
+    pos_path,
+    hpts_path,
+    overwrite=True,
+    manifest_path=None
+):
+    """Convert a set of electrode locations recorded with a Polhemus FASTRAK
+    (and saved in '.pos' format) to the 'hpts' format that can be used with the
+    MNE suite.
+
+    Parameters
+    ----------
+    pos_path: string
+        Path to the Polhemus 'pos' file, as written by BrainStorm.
+    hpts_path: string
+        Path to the 'hpts' file to write.
+    overwrite: bool, optional
+        Whether to overwrite ``hpts_path``, if it exists.
+    manifest_path: string, optional
+        Path to a conversion manifest (see ``is_conversion_current``). If
+        given, the conversion is skipped when ``hpts_path`` is up to date with
+        ``pos_path``, and is recorded in the manifest otherwise.
+
+    """
+
+    params = {"converter": "convert_fastrak_to_hpts"}
+
+    if manifest_path is not None and is_conversion_current(
+        manifest_path=manifest_path,
+        output_path=hpts_path,
+        input_paths=[pos_path],
+        params=params
+    ):
+        logger.info(hpts_path + " is up to date; skipping")
+        return
+
+    if not overwrite and os.path.exists(hpts_path):
+        raise ValueError("Output path " + hpts_path + " already exists")
+
+    _write_hpts(
+        points=read_fastrak_pos(pos_path=pos_path),
+        pos_path=pos_path,
+        hpts_path=hpts_path
+    )
+
+    if manifest_path is not None:
+        record_conversion(
+            manifest_path=manifest_path,
+            output_path=hpts_path,
+            input_paths=[pos_path],
+            params=params
+        )
+
+
+def read_fastrak_pos(pos_path):
+    """Read a set of electrode locations recorded with a Polhemus FASTRAK
+    (and saved in '.pos' format), without writing any files.
+
+    Parameters
+    ----------
+    pos_path: string
+        Path to the Polhemus 'pos' file, as written by BrainStorm.
+
+    Returns
+    -------
+    points: structured array, shape (n_points,)
+        With fields "category" (the hpts category; "cardinal", "eeg", or
+        "extra"), "identifier" (the hpts identifier), and "x", "y", and "z"
+        (the position, in mm).
+
+    """
+
+    (categories, identifiers, positions) = _parse_pos(pos_path=pos_path)
+
+    points = np.empty(len(categories), dtype=_DIG_POINTS_DTYPE)
+
+    points["category"] = categories
+    points["identifier"] = identifiers
+
+    (points["x"], points["y"], points["z"]) = positions.T
+
+    return points
+
+
+def _write_hpts(points, pos_path, hpts_path, chunk_points=4096):
+    """Write the points read from ``pos_path`` to a 'hpts' file.
+
+    The rows are formatted and written ``chunk_points`` at a time, so only
+    one block of the text is held in memory. Each coordinate is written as
+    its shortest round-trip representation, as before.
+
+    """
+
+    header = "# Converted from " + pos_path + " to " + hpts_path + "\n"
+    header += "# " + str(datetime.datetime.now()) + "\n"
+
+    with _open_atomic(hpts_path) as hpts_file:
+
+        hpts_file.write(header)
+
+        for i_point in range(0, len(points), chunk_points):
+
+            block = points[i_point:i_point + chunk_points]
+
+            hpts_file.write(
+                "".join(
+                    "%s %d %r %r %r\n" % row
+                    for row in zip(
+                        block["category"].tolist(),
+                        block["identifier"].tolist(),
+                        block["x"].tolist(),
+                        block["y"].tolist(),
+                        block["z"].tolist()
+                    )
+                )
+            )
+
+
+def _parse_pos(pos_path):
+    """Parse a Polhemus 'pos' file, as written by BrainStorm, in one pass.
+
+    The rows are told apart by their number of tab-separated fields: the
+    cardinal points have four (name and position) and the EEG and headshape
+    ('extra') points have five (index, name, and position), with headshape
+    points having an empty name.
+
+    Returns
+    -------
+    categories: string array, shape (n_points,)
+        The hpts category of each point; "cardinal", "eeg", or "extra".
+    identifiers: int array, shape (n_points,)
+        The hpts identifier of each point. Cardinal points are numbered
+        LPA = 1, nasion = 2, and RPA = 3, and the others are numbered from 1
+        within their category.
+    positions: float array, shape (n_points, 3)
+        The position of each point, in mm.
+
+    """
+
+    with open(pos_path, "r") as pos_file:
+        raw_data = pos_file.read().splitlines()
+
+    # ignore the first
+    lines = np.array([line.strip() for line in raw_data[1:] if line.strip()])
+
+    if len(lines) == 0:
+        return (
+            np.array([], dtype="U8"),
+            np.array([], dtype=int),
+            np.empty((0, 3))
+        )
+
+    n_fields = np.char.count(lines, "\t") + 1
+
+    is_cardinal = n_fields == 4
+    is_point = n_fields == 5
+
+    if not np.all(is_cardinal | is_point):
+        raise ValueError(
+            "Unexpected number of fields in " + pos_path + " on line(s) " +
+            str(list(np.flatnonzero(~(is_cardinal | is_point)) + 2))
+        )
+
+    # split off the first field, and then the name for five-field rows
+    (names, _, coord_text) = np.char.partition(lines, "\t").T
+
+    (point_names, _, coord_text[is_point]) = np.char.partition(
+        coord_text[is_point], "\t"
+    ).T
+
+    names[is_point] = point_names
+
+    is_eeg = is_point & (names != "")
+    is_extra = is_point & (names == "")
+
+    # position is given in cm, so needs to be converted to mm
+    positions = np.array(
+        "\t".join(coord_text.tolist()).split("\t"), dtype=np.float64
+    ).reshape(-1, 3) * 10
+
+    categories = np.full(len(lines), "cardinal", dtype="U8")
+    categories[is_eeg] = "eeg"
+    categories[is_extra] = "extra"
+
+    identifiers = np.zeros(len(lines), dtype=int)
+
+    identifiers[is_eeg] = np.arange(1, np.sum(is_eeg) + 1)
+    identifiers[is_extra] = np.arange(1, np.sum(is_extra) + 1)
+
+    for (cardinal_name, identifier) in [("LPA", 1), ("NA", 2), ("RPA", 3)]:
+        identifiers[is_cardinal & (names == cardinal_name)] = identifier
+
+    if np.any(identifiers[is_cardinal] == 0):
+        raise ValueError("Unknown cardinal point in " + pos_path)
+
+    return (categories, identifiers, positions)
+
+
+def _points_to_dig(points):
+    """Convert digitiser points (see ``read_fastrak_pos``) to FIF digitiser
+    points, in metres and (if all three cardinal points are present) in head
+    coordinates."""
+
+    kinds = {
+        "cardinal": _FIFFV_POINT_CARDINAL,
+        "hpi": _FIFFV_POINT_HPI,
+        "eeg": _FIFFV_POINT_EEG,
+        "extra": _FIFFV_POINT_EXTRA
+    }
+
+    dig = np.empty(len(points), dtype=_FIF_DIG_POINT_DTYPE)
+
+    dig["kind"] = [kinds[category] for category in points["category"]]
+    dig["ident"] = points["identifier"]
+
+    # positions are in mm
+    positions = np.column_stack(
+        [points["x"], points["y"], points["z"]]
+    ) / 1000.0
+
+    is_cardinal = points["category"] == "cardinal"
+
+    cardinal = dict(
+        zip(points["identifier"][is_cardinal], positions[is_cardinal])
+    )
+
+    # LPA is 1, nasion is 2, and RPA is 3
+    if all(ident in cardinal for ident in [1, 2, 3]):
+        positions = _to_head_coords(
+            positions=positions,
+            lpa=cardinal[1],
+            nasion=cardinal[2],
+            rpa=cardinal[3]
+        )
+
+    dig["r"] = positions
+
+    return dig
+
+
+def _to_head_coords(positions, lpa, nasion, rpa):
+    """Transform positions into the Neuromag head coordinate frame: x runs
+    from LPA to RPA, y passes through the nasion, and z points up."""
+
+    ex = (rpa - lpa) / np.linalg.norm(rpa - lpa)
+
+    origin = lpa + np.dot(nasion - lpa, ex) * ex
+
+    ey = (nasion - origin) / np.linalg.norm(nasion - origin)
+
+    ez = np.cross(ex, ey)
+
+    return np.dot(positions - origin, np.array([ex, ey, ez]).T)
+
+
+def convert_brain_vision_to_csv(
+    vhdr_path,
+    dat_path,
+    csv_path,
+    start_ms=-200.0,
+    manifest_path=None,
+    dtype=np.float64,
+    precision=12,
+    channels=None,
+    tmin_ms=None,
+    tmax_ms=None
+):
+    """Convert an ERP exported from BrainVision Analyzer, as a header and
+    ASCII vectorized data file, to a CSV file with a time column followed by
+    a column for each channel.
+
+    This is ``convert_brain_vision`` with an ``output_format`` of "csv"; see
+    there for the parameters.
+
+    """
+
+    return convert_brain_vision(
+        vhdr_path=vhdr_path,
+        dat_path=dat_path,
+        out_path=csv_path,
+        output_format="csv",
+        start_ms=start_ms,
+        manifest_path=manifest_path,
+        dtype=dtype,
+        precision=precision,
+        channels=channels,
+        tmin_ms=tmin_ms,
+        tmax_ms=tmax_ms
+    )
+
+
+def convert_brain_vision(
+    vhdr_path,
+    dat_path,
+    out_path,
+    output_format="csv",
+    start_ms=-200.0,
+    manifest_path=None,
+    dtype=np.float64,
+    precision=12,
+    channels=None,
+    tmin_ms=None,
+    tmax_ms=None
+):
+    """Convert an ERP exported from BrainVision Analyzer, as a header and
+    ASCII vectorized data file, to a time by (time and channels) matrix.
+
+    Parameters
+    ----------
+    vhdr_path, dat_path: string
+        Paths to the header and data files.
+    out_path: string
+        Path to the file to write.
+    output_format: {"csv", "npy", "raw"}, optional
+        "csv" writes a CSV file with a header row of column names. "npy"
+        writes the matrix with ``np.save``, and "raw" writes it as bare
+        little-endian float32 values in C order; both can then be memory
+        mapped, with ``np.load(out_path, mmap_mode="r")`` and ``np.memmap``
+        respectively. For "npy" and "raw", a JSON sidecar (``out_path`` with
+        a '.json' extension) holds the column names, shape, dtype, time axis,
+        and the '[Common Infos]' of the header.
+    start_ms: float, optional
+        Time of the first sample, in ms.
+    manifest_path: string, optional
+        Path to a conversion manifest (see ``is_conversion_current``). If
+        given, the conversion is skipped (and ``None`` returned) when
+        ``out_path`` is up to date with its inputs, and is recorded in the
+        manifest otherwise.
+    dtype: numpy dtype, optional
+        Floating point type of the returned data (and of a "npy" output).
+    precision: int, optional
+        Number of decimal places written to a CSV file.
+    channels: list of strings, optional
+        Names of the channels to include, in order. Only these rows of the
+        data file are parsed. If not given, all channels are included.
+    tmin_ms, tmax_ms: float, optional
+        Times, in ms, of the first and last samples to include; parsing of
+        each row stops after ``tmax_ms``. If not given, the window extends to
+        the start and end of the data.
+
+    Returns
+    -------
+    data: array, shape (n_samples, n_channels + 1)
+        The time and channel data written to ``out_path``.
+
+    """
+
+    if output_format not in ["csv", "npy", "raw"]:
+        raise ValueError("Unknown output format " + str(output_format))
+
+    input_paths = [vhdr_path, dat_path]
+
+    params = {
+        "converter": "convert_brain_vision",
+        "output_format": output_format,
+        "start_ms": start_ms,
+        "dtype": np.dtype(dtype).name,
+        "precision": precision,
+        "channels": channels,
+        "tmin_ms": tmin_ms,
+        "tmax_ms": tmax_ms
+    }
+
+    if manifest_path is not None and is_conversion_current(
+        manifest_path=manifest_path,
+        output_path=out_path,
+        input_paths=input_paths,
+        params=params
+    ):
+        logger.info(out_path + " is up to date; skipping")
+        return None
+
+    (vhdr, header, data) = _read_brain_vision_erp(
+        vhdr_path=vhdr_path,
+        dat_path=dat_path,
+        start_ms=start_ms,
+        dtype=dtype,
+        channels=channels,
+        tmin_ms=tmin_ms,
+        tmax_ms=tmax_ms
+    )
+
+    if output_format == "csv":
+
+        _write_csv(
+            csv_path=out_path,
+            data=data,
+            header=",".join(header),
+            precision=precision
+        )
+
+    else:
+
+        if output_format == "npy":
+
+            with _open_atomic(out_path, mode="wb") as out_file:
+                np.save(out_file, data)
+
+            out_dtype = data.dtype
+
+        else:
+
+            out_dtype = np.dtype("<f4")
+
+            with _open_atomic(out_path, mode="wb") as out_file:
+                out_file.write(np.ascontiguousarray(data, dtype=out_dtype))
+
+        sidecar = {
+            "columns": header,
+            "shape": list(data.shape),
+            "dtype": out_dtype.str,
+            "order": "C",
+            "time_ms": {
+                "start": float(data[0, 0]),
+                "step": vhdr.sampling_interval / 1000.0,
+                "n": len(data)
+            },
+            "n_averaged": vhdr.n_averaged,
+            "common_infos": vhdr.sections["Common Infos"]
+        }
+
+        (out_base, _) = os.path.splitext(out_path)
+
+        with _open_atomic(out_base + ".json") as sidecar_file:
+            json.dump(sidecar, sidecar_file, indent=1)
+
+    if manifest_path is not None:
+        record_conversion(
+            manifest_path=manifest_path,
+            output_path=out_path,
+            input_paths=input_paths,
+            params=params
+        )
+
+    return data
+
+
+def grand_average_brain_vision(
+    erp_paths,
+    start_ms=-200.0,
+    channels=None,
+    tmin_ms=None,
+    tmax_ms=None,
+    ddof=1
+):
+    """Compute the grand average of many ERPs exported from BrainVision
+    Analyzer, one file at a time.
+
+    Each ERP is parsed in turn and folded into running per-sample statistics
+    with Welford's algorithm, so memory use does not grow with the number of
+    files.
+
+    Parameters
+    ----------
+    erp_paths: sequence of (string, string)
+        Paths to the header and data files of each ERP.
+    start_ms: float, optional
+        Time of the first sample, in ms.
+    channels: list of strings, optional
+        Names of the channels to include, in order. If not given, all
+        channels are included, and must be in the same order in every file.
+    tmin_ms, tmax_ms: float, optional
+        Times, in ms, of the first and last samples to include.
+    ddof: int, optional
+        Delta degrees of freedom of the variance.
+
+    Returns
+    -------
+    ch_names: list of strings
+        Names of the channels.
+    times: array, shape (n_samples,)
+        Time of each sample, in ms.
+    mean, var: arrays, shape (n_samples, n_channels)
+        Mean and variance across the ERPs.
+    n: int
+        Number of ERPs.
+
+    """
+
+    ch_names = None
+
+    for (vhdr_path, dat_path) in erp_paths:
+
+        (vhdr, header, data) = _read_brain_vision_erp(
+            vhdr_path=vhdr_path,
+            dat_path=dat_path,
+            start_ms=start_ms,
+            channels=channels,
+            tmin_ms=tmin_ms,
+            tmax_ms=tmax_ms
+        )
+
+        sample_interval = vhdr.sampling_interval
+
+        if ch_names is None:
+
+            ch_names = header[1:]
+            times = data[:, 0].copy()
+            first_interval = sample_interval
+
+            mean = np.zeros(data[:, 1:].shape)
+            m2 = np.zeros(data[:, 1:].shape)
+            n = 0
+
+            delta = np.empty(mean.shape)
+
+        else:
+
+            if sample_interval != first_interval:
+                raise ValueError(
+                    "Sampling interval of " + vhdr_path + " (" +
+                    str(sample_interval) + ") does not match " +
+                    str(first_interval)
+                )
+
+            if header[1:] != ch_names:
+                raise ValueError(
+                    "Channels of " + vhdr_path + " do not match those of " +
+                    "the first file"
+                )
+
+            if len(data) != len(times):
+                raise ValueError(
+                    "Number of samples of " + vhdr_path + " (" +
+                    str(len(data)) + ") does not match " + str(len(times))
+                )
+
+        values = data[:, 1:]
+
+        n += 1
+
+        # Welford's update
+        np.subtract(values, mean, out=delta)
+
+        mean += delta / n
+
+        values -= mean
+        values *= delta
+        m2 += values
+
+    if ch_names is None:
+        raise ValueError("No ERP files given")
+
+    if n > ddof:
+        var = m2 / (n - ddof)
+    else:
+        var = np.full(m2.shape, np.nan)
+
+    return (ch_names, times, mean, var, n)
+
+
+def stack_brain_vision(
+    erp_paths,
+    out_path,
+    start_ms=-200.0,
+    dtype=np.float64,
+    channels=None,
+    tmin_ms=None,
+    tmax_ms=None,
+    jobs=None
+):
+    """Stack many ERPs exported from BrainVision Analyzer into a single
+    ERP by time by channel array, saved as a '.npy' file.
+
+    The array is preallocated as a memory-mapped file, and each ERP is
+    parsed straight into its slice of it; with several jobs, each worker
+    process opens the file itself, so no data is passed between processes.
+
+    Parameters
+    ----------
+    erp_paths: sequence of (string, string)
+        Paths to the header and data files of each ERP.
+    out_path: string
+        Path to the '.npy' file to write.
+    start_ms: float, optional
+        Time of the first sample, in ms.
+    dtype: numpy dtype, optional
+        Floating point type of the array.
+    channels: list of strings, optional
+        Names of the channels to include, in order. If not given, the
+        channels of the first ERP are used, in its order.
+    tmin_ms, tmax_ms: float, optional
+        Times, in ms, of the first and last samples to include.
+    jobs: int, optional
+        Number of worker processes. If not given, it is the number of CPUs.
+        If 1, the files are parsed in this process.
+
+    Returns
+    -------
+    ch_names: list of strings
+        Names of the channels.
+    times: array, shape (n_samples,)
+        Time of each sample, in ms.
+    stack: array, shape (n_erps, n_samples, n_channels)
+        The stacked data, memory mapped read-only from ``out_path``.
+
+    """
+
+    erp_paths = list(erp_paths)
+
+    if not erp_paths:
+        raise ValueError("No ERP files given")
+
+    (vhdr_path, dat_path) = erp_paths[0]
+
+    vhdr = read_brain_vision_header(vhdr_path=vhdr_path)
+
+    (i_start, i_stop) = _get_time_window(
+        n_samples=vhdr.n_samples,
+        start_ms=start_ms,
+        step_ms=vhdr.sampling_interval / 1000.0,
+        tmin_ms=tmin_ms,
+        tmax_ms=tmax_ms
+    )
+
+    times = np.arange(i_start, i_stop) / vhdr.sfreq * 1000.0 + start_ms
+
+    if channels is None:
+        with open(dat_path, "r") as handle:
+            channels = [
+                _DAT_NAME_PATTERN.match(row).group(1)
+                for row in handle
+                if row.strip()
+            ]
+
+    with _open_atomic(out_path, mode="wb") as out_file:
+
+        stack = np.lib.format.open_memmap(
+            out_file.name,
+            mode="w+",
+            dtype=dtype,
+            shape=(len(erp_paths), len(times), len(channels))
+        )
+
+        jobs_args = [
+            (vhdr_path, dat_path, out_file.name, i_erp)
+            for (i_erp, (vhdr_path, dat_path)) in enumerate(erp_paths)
+        ]
+
+        kwargs = {
+            "channels": channels,
+            "sampling_interval": vhdr.sampling_interval,
+            "n_samples": vhdr.n_samples,
+            "i_start": i_start
+        }
+
+        if jobs == 1:
+
+            for job_args in jobs_args:
+                _stack_erp_job(*job_args, stack=stack, **kwargs)
+
+        else:
+
+            stack.flush()
+
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs
+            ) as executor:
+
+                # any error is raised here, by ``result``
+                for future in [
+                    executor.submit(_stack_erp_job, *job_args, **kwargs)
+                    for job_args in jobs_args
+                ]:
+                    future.result()
+
+        stack.flush()
+
+        del stack
+
+    logger.info(
+        "Stacked " + str(len(erp_paths)) + " ERPs into " + out_path
+    )
+
+    return (channels, times, np.load(out_path, mmap_mode="r"))
+
+
+def _stack_erp_job(
+    vhdr_path,
+    dat_path,
+    stack_path,
+    i_erp,
+    channels,
+    sampling_interval,
+    n_samples,
+    i_start,
+    stack=None
+):
+    "Parse an ERP into its slice of a stack, opening the stack if not given."
+
+    vhdr = read_brain_vision_header(vhdr_path=vhdr_path)
+
+    if (
+        vhdr.sampling_interval != sampling_interval or
+        vhdr.n_samples != n_samples
+    ):
+        raise ValueError(
+            "Sampling rate or number of samples of " + vhdr_path +
+            " does not match the first file"
+        )
+
+    if stack is None:
+        stack = np.load(stack_path, mmap_mode="r+")
+
+    _read_brain_vision_dat(
+        dat_path=dat_path,
+        out=stack[i_erp].T,
+        n_channels=vhdr.n_channels,
+        n_samples=n_samples,
+        decimal_symbol=vhdr.decimal_symbol,
+        channels=channels,
+        i_start=i_start
+    )
+
+    stack.flush()
+
+
+def _read_brain_vision_erp(
+    vhdr_path,
+    dat_path,
+    start_ms=-200.0,
+    dtype=np.float64,
+    channels=None,
+    tmin_ms=None,
+    tmax_ms=None
+):
+    "Read an exported ERP as its header, column names and time/data matrix."
+
+    vhdr = read_brain_vision_header(vhdr_path=vhdr_path)
+
+    (i_start, i_stop) = _get_time_window(
+        n_samples=vhdr.n_samples,
+        start_ms=start_ms,
+        step_ms=vhdr.sampling_interval / 1000.0,
+        tmin_ms=tmin_ms,
+        tmax_ms=tmax_ms
+    )
+
+    # time, in ms
+    t = np.arange(i_start, i_stop) / vhdr.sfreq * 1000.0
+
+    # convert to ERP time
+    t += start_ms
+
+    n_selected = vhdr.n_channels if channels is None else len(channels)
+
+    data = np.full((len(t), n_selected + 1), np.nan, dtype=dtype)
+
+    data[:, 0] = t
+
+    header = ["time(ms)"]
+
+    header.extend(
+        _read_brain_vision_dat(
+            dat_path=dat_path,
+            out=data[:, 1:].T,
+            n_channels=vhdr.n_channels,
+            n_samples=vhdr.n_samples,
+            decimal_symbol=vhdr.decimal_symbol,
+            channels=channels,
+            i_start=i_start
+        )
+    )
+
+    assert np.sum(np.isnan(data)) == 0
+
+    return (vhdr, header, data)
+
+
+class BrainVisionHeader(object):
+    """The contents of a BrainVision header file ('.vhdr').
+
+    Returned by ``read_brain_vision_header``, and shared between calls for
+    the same unchanged file; it should not be modified.
+
+    Attributes
+    ----------
+    vhdr_path: string
+    sections: dict
+        Every key and value, as strings, by section name.
+    data_file: string
+        Name of the data file, relative to the header.
+    data_format: string
+        "ASCII" or "BINARY".
+    orientation: string
+        "VECTORIZED" or "MULTIPLEXED".
+    binary_format: string or None
+        e.g. "INT_16" or "IEEE_FLOAT_32", for a binary data file.
+    decimal_symbol: string
+        Decimal symbol of an ASCII data file.
+    sampling_interval: float
+        Time between samples, in microseconds.
+    sfreq: float
+        Sampling rate, in Hz.
+    n_samples: int or None
+        Number of samples ("DataPoints"), if given.
+    n_averaged: int or None
+        Number of segments averaged ("AveragedSegments"), if given.
+    n_channels: int
+    ch_names, references, units: lists of strings
+    resolutions: float array, shape (n_channels,)
+
+    """
+
+    def __init__(self, vhdr_path, sections):
+
+        self.vhdr_path = vhdr_path
+        self.sections = sections
+
+        common = self._get_section("Common Infos")
+
+        try:
+            self.data_file = common["DataFile"]
+            self.n_channels = int(common["NumberOfChannels"])
+            self.sampling_interval = float(common["SamplingInterval"])
+        except KeyError as error:
+            raise ValueError(
+                str(error) + " missing from '[Common Infos]' of " + vhdr_path
+            )
+
+        self.sfreq = 1000000.0 / self.sampling_interval
+
+        self.data_format = common.get("DataFormat", "ASCII")
+        self.orientation = common.get("DataOrientation", "MULTIPLEXED")
+
+        self.n_samples = self._get_int(common, "DataPoints")
+        self.n_averaged = self._get_int(common, "AveragedSegments")
+
+        self.binary_format = sections.get("Binary Infos", {}).get(
+            "BinaryFormat"
+        )
+
+        self.decimal_symbol = sections.get("ASCII Infos", {}).get(
+            "DecimalSymbol", "."
+        )
+
+        channel_infos = self._get_section("Channel Infos")
+
+        self.ch_names = []
+        self.references = []
+        self.units = []
+        self.resolutions = np.ones(self.n_channels)
+
+        for i_chan in range(self.n_channels):
+
+            ch_key = "Ch" + str(i_chan + 1)
+
+            if ch_key not in channel_infos:
+                raise ValueError(ch_key + " missing from " + vhdr_path)
+
+            # name, reference, resolution, unit
+            ch_info = channel_infos[ch_key].split(",")
+
+            self.ch_names.append(ch_info[0].replace(r"\1", ","))
+
+            if len(ch_info) > 1:
+                self.references.append(ch_info[1].replace(r"\1", ","))
+            else:
+                self.references.append("")
+
+            if len(ch_info) > 2 and ch_info[2] != "":
+                self.resolutions[i_chan] = float(ch_info[2])
+
+            if len(ch_info) > 3:
+                self.units.append(ch_info[3])
+            else:
+                self.units.append(u"\u00b5V")
+
+        self.resolutions.flags.writeable = False
+
+    def _get_section(self, name):
+        "Get a section that must be present."
+
+        if name not in self.sections:
+            raise ValueError(
+                "No '[" + name + "]' section in " + self.vhdr_path
+            )
+
+        return self.sections[name]
+
+    @staticmethod
+    def _get_int(section, key):
+        "Get an optional integer value."
+
+        if section.get(key, "") == "":
+            return None
+
+        return int(section[key])
+
+
+def read_brain_vision_header(vhdr_path):
+    """Read a BrainVision header file ('.vhdr').
+
+    Only the header is read. The result is cached by path, and reused while
+    the file's modification time and size are unchanged.
+
+    Parameters
+    ----------
+    vhdr_path: string
+        Path to the header file.
+
+    Returns
+    -------
+    vhdr: BrainVisionHeader
+
+    """
+
+    cache_key = os.path.abspath(vhdr_path)
+
+    vhdr_stat = os.stat(vhdr_path)
+
+    file_id = (vhdr_stat.st_mtime_ns, vhdr_stat.st_size)
+
+    cached = _VHDR_CACHE.get(cache_key)
+
+    if cached is not None and cached[0] == file_id:
+        return cached[1]
+
+    vhdr = BrainVisionHeader(
+        vhdr_path=vhdr_path, sections=_parse_vhdr(vhdr_path=vhdr_path)
+    )
+
+    _VHDR_CACHE[cache_key] = (file_id, vhdr)
+
+    return vhdr
+
+
+def _parse_vhdr(vhdr_path):
+    """Read the key/value pairs of each section of a BrainVision header, up
+    to the free-text '[Comment]' section that ends Recorder headers."""
+
+    # the first line identifies the file type
+    lines = _read_text(file_path=vhdr_path).splitlines()[1:]
+
+    sections = {}
+    section = None
+
+    for line in lines:
+
+        line = line.strip()
+
+        if not line or line[0] == ";":
+            continue
+
+        if line[0] == "[":
+
+            name = line[1:line.index("]")]
+
+            if name == "Comment":
+                break
+
+            section = sections.setdefault(name, {})
+            continue
+
+        (key, separator, value) = line.partition("=")
+
+        if section is None or not separator:
+            raise ValueError(
+                "Unexpected line in " + vhdr_path + ": " + line
+            )
+
+        section[key.strip()] = value.strip()
+
+    return sections
+
+
+class BrainVisionEEG(object):
+    """Lazy access to a binary BrainVision recording ('.vhdr' and '.eeg').
+
+    The data file is memory-mapped, in either MULTIPLEXED or VECTORIZED
+    orientation, and nothing is read until the object is indexed. Indexing
+    with ``[channels, samples]`` (or just ``[channels]``) returns the
+    selected values scaled by each channel's resolution, in the units of the
+    '[Channel Infos]' section (usually microvolts).
+
+    Parameters
+    ----------
+    vhdr_path: string
+        Path to the header file.
+
+    Attributes
+    ----------
+    ch_names: list of strings
+    units: list of strings
+    resolutions: float array, shape (n_channels,)
+    sfreq: float
+        Sampling rate, in Hz.
+    n_channels, n_samples: int
+    raw: array, shape (n_channels, n_samples)
+        The unscaled values, as a view onto the memory map.
+
+    """
+
+    _BINARY_FORMATS = {
+        "INT_16": "<i2",
+        "UINT_16": "<u2",
+        "INT_32": "<i4",
+        "IEEE_FLOAT_32": "<f4"
+    }
+
+    def __init__(self, vhdr_path):
+
+        vhdr = read_brain_vision_header(vhdr_path=vhdr_path)
+
+        if vhdr.data_format.upper() != "BINARY":
+            raise ValueError(vhdr_path + " does not describe a binary file")
+
+        binary_format = vhdr.binary_format
+
+        if binary_format not in self._BINARY_FORMATS:
+            raise ValueError("Unsupported binary format " + str(binary_format))
+
+        orientation = vhdr.orientation
+
+        self.n_channels = vhdr.n_channels
+        self.sfreq = vhdr.sfreq
+        self.ch_names = list(vhdr.ch_names)
+        self.units = list(vhdr.units)
+        self.resolutions = vhdr.resolutions.copy()
+
+        self.eeg_path = os.path.join(
+            os.path.dirname(vhdr_path), vhdr.data_file
+        )
+
+        dtype = np.dtype(self._BINARY_FORMATS[binary_format])
+
+        # the number of points is not always given for continuous data
+        self.n_samples = os.path.getsize(self.eeg_path) // (
+            dtype.itemsize * self.n_channels
+        )
+
+        if orientation.upper() == "MULTIPLEXED":
+
+            self.raw = np.memmap(
+                self.eeg_path,
+                dtype=dtype,
+                mode="r",
+                shape=(self.n_samples, self.n_channels)
+            ).T
+
+        elif orientation.upper() == "VECTORIZED":
+
+            self.raw = np.memmap(
+                self.eeg_path,
+                dtype=dtype,
+                mode="r",
+                shape=(self.n_channels, self.n_samples)
+            )
+
+        else:
+            raise ValueError("Unknown data orientation " + orientation)
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+
+        values = self.raw[key]
+
+        scale = self.resolutions[key[0]]
+
+        # a row per channel, so the scales need to go down the rows
+        if np.ndim(scale) == 1 and values.ndim == 2:
+            scale = scale[:, np.newaxis]
+
+        return values * scale
+
+    def get_data(self, channels=None, tmin_ms=None, tmax_ms=None):
+        """Get the scaled values of a set of channels within a time window.
+
+        Only the selected channels and samples are read from the memory map.
+
+        Parameters
+        ----------
+        channels: list of strings, optional
+            Names of the channels to get, in order. If not given, all
+            channels are returned.
+        tmin_ms, tmax_ms: float, optional
+            Times, in ms relative to the first sample, of the first and last
+            samples to get. If not given, the window extends to the start and
+            end of the recording.
+
+        Returns
+        -------
+        data: array, shape (n_selected_channels, n_window_samples)
+
+        """
+
+        if channels is None:
+            i_chans = slice(None)
+        else:
+            i_chans = _get_channel_indices(
+                ch_names=self.ch_names, channels=channels
+            )
+
+        (i_start, i_stop) = _get_time_window(
+            n_samples=self.n_samples,
+            start_ms=0.0,
+            step_ms=1000.0 / self.sfreq,
+            tmin_ms=tmin_ms,
+            tmax_ms=tmax_ms
+        )
+
+        return self[i_chans, i_start:i_stop]
+
+    def get_epochs(
+        self, events, tmin_ms, tmax_ms, baseline_ms=None, channels=None
+    ):
+        """Cut epochs around a set of events, scaled by each channel's
+        resolution.
+
+        See ``epoch_data``; only the samples within the epochs are read from
+        the memory map.
+
+        Parameters
+        ----------
+        events: int array, shape (n_epochs,)
+            Sample of each event, e.g. from ``read_brain_vision_markers``.
+        tmin_ms, tmax_ms: float
+            Times, in ms relative to the events, of the first and last
+            samples of each epoch.
+        baseline_ms: (float or None, float or None), optional
+            Times, in ms relative to the events, of the start and end of the
+            baseline period, whose mean is subtracted from each epoch and
+            channel. ``None`` means the start or end of the epoch.
+        channels: list of strings, optional
+            Names of the channels to get, in order. If not given, all
+            channels are returned.
+
+        Returns
+        -------
+        epochs: array, shape (n_epochs, n_selected_channels, n_times)
+        times: array, shape (n_times,)
+            Time of each sample relative to the events, in ms.
+
+        """
+
+        if channels is None:
+            i_chans = np.arange(self.n_channels)
+        else:
+            i_chans = _get_channel_indices(
+                ch_names=self.ch_names, channels=channels
+            )
+
+        return epoch_data(
+            data=self.raw,
+            events=events,
+            sfreq=self.sfreq,
+            tmin_ms=tmin_ms,
+            tmax_ms=tmax_ms,
+            baseline_ms=baseline_ms,
+            channel_indices=i_chans,
+            scale=self.resolutions[i_chans]
+        )
+
+
+class BrainVisionMarkers(object):
+    """The markers of a BrainVision marker file ('.vmrk'), sorted by
+    position.
+
+    The types and descriptions are held as integer codes into lists of the
+    distinct strings, so that markers can be selected with array operations.
+
+    Attributes
+    ----------
+    sample: int array, shape (n_markers,)
+        Position of each marker, in samples from the start of the data (so
+        zero-based, unlike the file).
+    duration: int array, shape (n_markers,)
+        Size of each marker, in samples.
+    channel: int array, shape (n_markers,)
+        Channel number of each marker (one-based), or 0 for all channels.
+    type_code, description_code: int arrays, shape (n_markers,)
+        Index of each marker's type and description in ``types`` and
+        ``descriptions``.
+    types, descriptions: lists of strings
+        The distinct types (e.g. "Stimulus") and descriptions (e.g. "S  1"),
+        in sorted order.
+
+    """
+
+    def __init__(
+        self,
+        sample,
+        duration,
+        channel,
+        type_code,
+        description_code,
+        types,
+        descriptions
+    ):
+
+        self.sample = sample
+        self.duration = duration
+        self.channel = channel
+        self.type_code = type_code
+        self.description_code = description_code
+        self.types = types
+        self.descriptions = descriptions
+
+    def __len__(self):
+        return len(self.sample)
+
+    def find(self, start=None, stop=None, description=None):
+        """Find the markers within a range of samples.
+
+        Parameters
+        ----------
+        start, stop: int, optional
+            First sample of the range, and the sample after its last. If not
+            given, the range extends to the first and last markers.
+        description: string, optional
+            If given, only markers with this description are found.
+
+        Returns
+        -------
+        indices: int array
+            Indices of the found markers, in order of position.
+
+        """
+
+        i_start = 0 if start is None else np.searchsorted(
+            self.sample, start, side="left"
+        )
+
+        i_stop = len(self) if stop is None else np.searchsorted(
+            self.sample, stop, side="left"
+        )
+
+        indices = np.arange(i_start, i_stop)
+
+        if description is not None:
+
+            if description not in self.descriptions:
+                return indices[:0]
+
+            indices = indices[
+                self.description_code[i_start:i_stop] ==
+                self.descriptions.index(description)
+            ]
+
+        return indices
+
+
+def read_brain_vision_markers(vmrk_path):
+    """Read a BrainVision marker file ('.vmrk').
+
+    The '[Marker Infos]' section is split into fields with array operations
+    on its bytes, and the numeric fields are converted digit by digit, so
+    there is no per-marker Python code.
+
+    Parameters
+    ----------
+    vmrk_path: string
+        Path to the marker file.
+
+    Returns
+    -------
+    markers: BrainVisionMarkers
+
+    """
+
+    with open(vmrk_path, "rb") as handle:
+        text = handle.read()
+
+    i_section = text.find(b"[Marker Infos]")
+
+    if i_section == -1:
+        raise ValueError("No '[Marker Infos]' section in " + vmrk_path)
+
+    i_end = text.find(b"\n[", i_section)
+
+    if i_end == -1:
+        i_end = len(text)
+
+    section = np.frombuffer(text[i_section:i_end], dtype=np.uint8)
+
+    # padded so that the first two bytes of every line can be looked at
+    padded = np.concatenate([section, np.zeros(2, dtype=np.uint8)])
+
+    newlines = np.flatnonzero(section == ord("\n"))
+
+    starts = np.concatenate([[0], newlines + 1])
+    ends = np.concatenate([newlines, [len(section)]])
+
+    ends -= (ends > starts) & (padded[ends - 1] == ord("\r"))
+
+    # Mk<number>=<type>,<description>,<position>[,<size>[,<channel>[,...]]]
+    is_marker = (
+        (padded[starts] == ord("M")) & (padded[starts + 1] == ord("k"))
+    )
+
+    # the delimiters of each line: the first '=', then up to five commas
+    bounds = np.repeat(ends[:, np.newaxis], 6, axis=1)
+
+    equals = np.flatnonzero(section == ord("="))
+    equals_line = np.searchsorted(newlines, equals)
+
+    (lines, i_first) = np.unique(equals_line, return_index=True)
+
+    bounds[lines, 0] = equals[i_first]
+
+    commas = np.flatnonzero(section == ord(","))
+    commas_line = np.searchsorted(newlines, commas)
+
+    # commas after the first '=', numbered along each line
+    after_equals = commas > bounds[commas_line, 0]
+
+    commas = commas[after_equals]
+    commas_line = commas_line[after_equals]
+
+    rank = np.arange(len(commas)) - np.searchsorted(commas_line, commas_line)
+
+    keep = rank < 5
+
+    bounds[commas_line[keep], rank[keep] + 1] = commas[keep]
+
+    bounds = bounds[is_marker]
+    ends = ends[is_marker]
+
+    n_markers = len(bounds)
+
+    if np.any(bounds[:, 2] == ends):
+        raise ValueError("Marker without a position in " + vmrk_path)
+
+    # each field runs from after a delimiter to the next one; the ones that
+    # are left out run backwards from after the end of the line
+    field_starts = bounds[:, :5] + 1
+    field_stops = np.maximum(bounds[:, 1:], field_starts)
+
+    fields = [
+        _gather_bytes(
+            data=padded, starts=field_starts[:, i_field],
+            stops=field_stops[:, i_field]
+        )
+        for i_field in range(5)
+    ]
+
+    (types, type_code) = np.unique(fields[0], return_inverse=True)
+
+    (descriptions, description_code) = np.unique(
+        fields[1], return_inverse=True
+    )
+
+    types = [_decode_text(raw=raw) for raw in types]
+
+    # commas in descriptions are escaped
+    descriptions = [
+        _decode_text(raw=raw).replace(r"\1", ",") for raw in descriptions
+    ]
+
+    try:
+        sample = _parse_uints(fields=fields[2], default=None)
+        duration = _parse_uints(fields=fields[3], default=1)
+        channel = _parse_uints(fields=fields[4], default=0)
+    except ValueError as error:
+        raise ValueError(str(error) + " in " + vmrk_path)
+
+    # the file counts from one
+    sample -= 1
+
+    order = np.argsort(sample, kind="stable")
+
+    return BrainVisionMarkers(
+        sample=sample[order],
+        duration=duration[order],
+        channel=channel[order],
+        type_code=type_code[order].reshape(n_markers),
+        description_code=description_code[order].reshape(n_markers),
+        types=types,
+        descriptions=descriptions
+    )
+
+
+def _gather_bytes(data, starts, stops):
+    "Gather byte ranges of an array into a fixed-width bytes array."
+
+    lengths = stops - starts
+
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+
+    offsets = np.arange(width)
+
+    gathered = data[
+        np.minimum(starts[:, np.newaxis] + offsets, len(data) - 1)
+    ]
+
+    gathered[offsets >= lengths[:, np.newaxis]] = 0
+
+    return np.ascontiguousarray(gathered).view("S" + str(width))[:, 0]
+
+
+def _parse_uints(fields, default):
+    """Convert a bytes array of unsigned decimal integers, which may be
+    surrounded by blanks, to an int64 array. Empty fields take ``default``,
+    or are invalid if it is ``None``."""
+
+    digits = fields.view(np.uint8).reshape(
+        len(fields), fields.dtype.itemsize
+    ).astype(np.int64)
+
+    digits -= ord("0")
+
+    is_digit = (digits >= 0) & (digits <= 9)
+
+    is_blank = np.isin(digits + ord("0"), [0, ord(" "), ord("\t")])
+
+    if not np.all(is_digit | is_blank):
+        raise ValueError("Invalid number")
+
+    if digits.shape[1] > 18:
+        raise ValueError("Number too long")
+
+    # the power of ten of each digit is the number of digits after it
+    powers = np.cumsum(is_digit[:, ::-1], axis=1)[:, ::-1] - is_digit
+
+    values = np.sum(
+        np.where(is_digit, digits * 10 ** powers, 0), axis=1
+    )
+
+    is_empty = ~np.any(is_digit, axis=1)
+
+    if default is not None:
+        values[is_empty] = default
+    elif np.any(is_empty):
+        raise ValueError("Missing number")
+
+    return values
+
+
+def epoch_data(
+    data,
+    events,
+    sfreq,
+    tmin_ms,
+    tmax_ms,
+    baseline_ms=None,
+    channel_indices=None,
+    scale=None,
+    dtype=np.float64
+):
+    """Cut epochs around a set of events from continuous data.
+
+    The epochs are gathered with a single fancy index into a sliding window
+    view of ``data``, so that only their samples are read when it is memory
+    mapped, and are scaled and baseline-corrected with broadcast operations.
+
+    Parameters
+    ----------
+    data: array, shape (n_channels, n_samples)
+        The continuous data, e.g. ``BrainVisionEEG.raw``.
+    events: int array, shape (n_epochs,)
+        Sample of each event.
+    sfreq: float
+        Sampling rate, in Hz.
+    tmin_ms, tmax_ms: float
+        Times, in ms relative to the events, of the first and last samples of
+        each epoch.
+    baseline_ms: (float or None, float or None), optional
+        Times, in ms relative to the events, of the start and end of the
+        baseline period, whose mean is subtracted from each epoch and channel.
+        ``None`` means the start or end of the epoch. If not given, there is
+        no baseline correction.
+    channel_indices: int array, optional
+        Indices of the channels to include, in order. If not given, all
+        channels are included.
+    scale: float array, shape (n_selected_channels,), optional
+        Factor to multiply each channel by.
+    dtype: numpy dtype, optional
+        Floating point type of the epochs.
+
+    Returns
+    -------
+    epochs: array, shape (n_epochs, n_selected_channels, n_times)
+    times: array, shape (n_times,)
+        Time of each sample relative to the events, in ms.
+
+    """
+
+    events = np.asarray(events, dtype=np.int64)
+
+    step_ms = 1000.0 / sfreq
+
+    # tolerance for times that are a whisker off a sample
+    tolerance = 1e-6
+
+    i_min = int(np.ceil(tmin_ms / step_ms - tolerance))
+    i_max = int(np.floor(tmax_ms / step_ms + tolerance))
+
+    n_times = i_max - i_min + 1
+
+    if n_times < 1:
+        raise ValueError("No samples in the requested time window")
+
+    starts = events + i_min
+
+    out_of_range = (starts < 0) | (starts + n_times > data.shape[1])
+
+    if np.any(out_of_range):
+        raise ValueError(
+            str(np.sum(out_of_range)) + " epoch(s) extend beyond the data"
+        )
+
+    if channel_indices is None:
+        channel_indices = np.arange(data.shape[0])
+
+    windows = np.lib.stride_tricks.sliding_window_view(
+        data, n_times, axis=1
+    )
+
+    epochs = windows[
+        np.asarray(channel_indices)[np.newaxis, :], starts[:, np.newaxis]
+    ].astype(dtype)
+
+    times = np.arange(i_min, i_max + 1) * step_ms
+
+    # the copy above is the only pass over the epochs that allocates; the
+    # baseline and scale are applied in place
+    if baseline_ms is not None:
+
+        (i_start, i_stop) = _get_time_window(
+            n_samples=n_times,
+            start_ms=times[0],
+            step_ms=step_ms,
+            tmin_ms=baseline_ms[0],
+            tmax_ms=baseline_ms[1]
+        )
+
+        epochs -= epochs[:, :, i_start:i_stop].mean(axis=2, keepdims=True)
+
+    if scale is not None:
+        epochs *= np.asarray(scale, dtype=dtype)[:, np.newaxis]
+
+    return (epochs, times)
+
+
+def _read_brain_vision_dat(
+    dat_path,
+    out,
+    n_channels,
+    n_samples,
+    decimal_symbol=".",
+    channels=None,
+    i_start=0
+):
+    """Read an ASCII vectorized BrainVision data file, with one row per
+    channel of the channel name followed by its values.
+
+    The file is read in one go, and each row is converted by NumPy's text
+    parser straight into its row of the preallocated ``out``, of shape
+    (n_selected_channels, n_window_samples); no Python floats are created.
+    Only the rows of ``channels`` (all, if ``None``) are parsed, in that
+    order, and parsing stops at the end of the window of samples that starts
+    at ``i_start``. The channel names are returned.
+
+    """
+
+    with open(dat_path, "r") as handle:
+        text = handle.read()
+
+    if decimal_symbol != ".":
+        text = text.replace(decimal_symbol, ".")
+
+    rows = [row for row in text.splitlines() if row.strip()]
+
+    if len(rows) != n_channels:
+        raise ValueError(
+            "Expected " + str(n_channels) + " channels in " + dat_path +
+            " but found " + str(len(rows))
+        )
+
+    # channel name to (row, start of the values in the row)
+    row_info = {}
+
+    for row in rows:
+        name_match = _DAT_NAME_PATTERN.match(row)
+        row_info[name_match.group(1)] = (row, name_match.end())
+
+    if channels is None:
+        channels = [_DAT_NAME_PATTERN.match(row).group(1) for row in rows]
+
+    missing = [ch_name for ch_name in channels if ch_name not in row_info]
+
+    if missing:
+        raise ValueError(
+            "Channel(s) " + ", ".join(missing) + " not in " + dat_path
+        )
+
+    i_stop = i_start + out.shape[1]
+
+    for (i_chan, ch_name) in enumerate(channels):
+
+        (row, i_values) = row_info[ch_name]
+
+        values = row[i_values:]
+
+        if i_stop == n_samples:
+
+            values = np.fromstring(values, dtype=out.dtype, sep=" ")
+
+            n_values = len(values)
+
+        else:
+
+            # parsing with a count does not notice a short row, so count the
+            # values up to the end of the window (exact if the row is short)
+            n_values = len(values.split(None, i_stop))
+
+            values = np.fromstring(
+                values, dtype=out.dtype, sep=" ", count=i_stop
+            )
+
+        if n_values < i_stop or (i_stop == n_samples and n_values != i_stop):
+            raise ValueError(
+                "Expected " + str(n_samples) + " values for " + ch_name +
+                " in " + dat_path + " but found " + str(n_values)
+            )
+
+        out[i_chan, :] = values[i_start:i_stop]
+
+    return list(channels)
+
+
+def _get_channel_indices(ch_names, channels):
+    "Indices of a list of channel names."
+
+    missing = [ch_name for ch_name in channels if ch_name not in ch_names]
+
+    if missing:
+        raise ValueError("Channel(s) " + ", ".join(missing) + " unknown")
+
+    return np.array([ch_names.index(ch_name) for ch_name in channels])
+
+
+def _read_text(file_path):
+    "Read a text file, as UTF-8 or, failing that, as Latin-1."
+
+    with open(file_path, "rb") as handle:
+        return _decode_text(raw=handle.read())
+
+
+def _decode_text(raw):
+    "Decode bytes as UTF-8 or, failing that, as Latin-1."
+
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("latin-1")
+
+
+def _get_time_window(n_samples, start_ms, step_ms, tmin_ms=None, tmax_ms=None):
+    """Indices (start, stop) of the samples whose times lie within
+    [tmin_ms, tmax_ms], given the time of the first sample and the sampling
+    interval (all in ms)."""
+
+    # tolerance for times that are a whisker off a sample
+    tolerance = 1e-6
+
+    i_start = 0
+    i_stop = n_samples
+
+    if tmin_ms is not None:
+        i_start = int(np.ceil((tmin_ms - start_ms) / step_ms - tolerance))
+
+    if tmax_ms is not None:
+        i_stop = int(np.floor((tmax_ms - start_ms) / step_ms + tolerance)) + 1
+
+    i_start = min(max(i_start, 0), n_samples)
+    i_stop = min(max(i_stop, i_start), n_samples)
+
+    if i_start == i_stop:
+        raise ValueError("No samples in the requested time window")
+
+    return (i_start, i_stop)
+
+
+def _write_csv(csv_path, data, header, precision=12, chunk_rows=4096):
+    """Write a 2-D array to a CSV file, with a header line and each value
+    written in fixed-point notation with ``precision`` decimal places.
+
+    The rows are formatted and written ``chunk_rows`` at a time, so ``data``
+    can be a memory map larger than the available memory.
+
+    """
+
+    with _open_atomic(csv_path, mode="wb") as csv_file:
+
+        csv_file.write((header + "\n").encode("utf-8"))
+
+        for i_row in range(0, data.shape[0], chunk_rows):
+            csv_file.write(
+                _format_csv_block(
+                    block=data[i_row:i_row + chunk_rows],
+                    precision=precision
+                )
+            )
+
+
+def _format_csv_block(block, precision):
+    """Format a (n_rows, n_cols) block of values as the bytes of CSV rows,
+    with each value as by ``"%.<precision>f"``.
+
+    Rather than formatting each value through Python, the values are split
+    into integer and fraction digits that are written a column at a time
+    into a fixed-width character matrix, with each value right-aligned on its
+    decimal point. The unused leading columns are then dropped in one
+    boolean selection. Values that are not finite or are too large for 64-bit
+    integers, and precisions above 15, are formatted by Python instead.
+
+    """
+
+    (n_rows, n_cols) = block.shape
+
+    values = np.asarray(block, dtype=np.float64).ravel()
+
+    if values.size == 0:
+        return b""
+
+    scale = 10 ** precision
+
+    abs_values = np.abs(values)
+
+    if (
+        precision > 15 or
+        not np.all(np.isfinite(abs_values)) or
+        np.max(abs_values) >= 2 ** 62
+    ):
+
+        row_format = ",".join(["%." + str(precision) + "f"] * n_cols) + "\n"
+
+        return ((row_format * n_rows) % tuple(values.tolist())).encode("ascii")
+
+    if precision == 0:
+
+        int_part = np.rint(abs_values).astype(np.int64)
+
+    else:
+
+        # split exactly into integer and fractional parts, and then round
+        # the scaled fraction exactly (with ties to even), as printf does
+        int_part = np.trunc(abs_values)
+
+        frac_part = _round_scaled(values=abs_values - int_part, scale=scale)
+
+        int_part = int_part.astype(np.int64)
+
+        # rounding up to the next integer
+        is_carry = frac_part == scale
+
+        int_part[is_carry] += 1
+        frac_part[is_carry] = 0
+
+    is_negative = np.signbit(values)
+
+    # number of digits before the decimal point, which is at least one
+    n_int = np.ones(values.size, dtype=np.int64)
+
+    power = 10
+
+    while power <= int_part.max():
+        n_int += int_part >= power
+        power *= 10
+
+    # a column for the sign, then the integer digits, the decimal point and
+    # fraction digits, and the separator
+    i_point = 1 + int(n_int.max())
+
+    width = i_point + (precision > 0) + precision + 1
+
+    chars = np.empty((values.size, width), dtype=np.uint8)
+
+    for i_col in range(i_point - 1, 0, -1):
+        quotient = int_part // 10
+        chars[:, i_col] = int_part - quotient * 10 + ord("0")
+        int_part = quotient
+
+    if precision > 0:
+
+        chars[:, i_point] = ord(".")
+
+        for i_col in range(width - 2, i_point, -1):
+            quotient = frac_part // 10
+            chars[:, i_col] = frac_part - quotient * 10 + ord("0")
+            frac_part = quotient
+
+    i_first = i_point - n_int - is_negative
+
+    chars[np.flatnonzero(is_negative), i_first[is_negative]] = ord("-")
+
+    chars[:, -1] = ord(",")
+    chars[n_cols - 1::n_cols, -1] = ord("\n")
+
+    keep = np.ones(chars.shape, dtype=bool)
+
+    keep[:, :i_point] = np.arange(i_point) >= i_first[:, np.newaxis]
+
+    return chars[keep].tobytes()
+
+
+def _round_scaled(values, scale):
+    """Round ``values * scale`` to the nearest integer, with ties to even, as
+    if the product were computed exactly (for products below 2 ** 52).
+
+    The rounding error of the product is recovered with Dekker's
+    error-free product, and is only needed to settle products that land
+    exactly half-way between two integers.
+
+    """
+
+    product = values * scale
+
+    # Veltkamp splits of each factor into two 26-bit halves
+    split = 134217729.0 * values
+    values_hi = split - (split - values)
+    values_lo = values - values_hi
+
+    split = 134217729.0 * scale
+    scale_hi = split - (split - scale)
+    scale_lo = scale - scale_hi
+
+    error = (
+        ((values_hi * scale_hi - product) + values_hi * scale_lo) +
+        values_lo * scale_hi
+    ) + values_lo * scale_lo
+
+    rounded = np.rint(product)
+
+    remainder = product - rounded
+
+    rounded[(remainder == 0.5) & (error > 0)] += 1
+    rounded[(remainder == -0.5) & (error < 0)] -= 1
+
+    return rounded.astype(np.int64)
+
+
+def is_conversion_current(manifest_path, output_path, input_paths, params):
+    """Check whether an output recorded in a conversion manifest is still up
+    to date.
+
+    The manifest is a JSON file that maps each output path to the size,
+    modification time, and content hash of each of its inputs, the
+    conversion parameters, and the version of this package. An output is
+    current if it exists and all of these still match. The inputs are only
+    hashed if their size and modification time no longer match the record,
+    so checking an unchanged output costs a few ``stat`` calls. An input
+    that was touched but whose content is unchanged has its new modification
+    time stored in the manifest, so that it is not hashed again.
+
+    Parameters
+    ----------
+    manifest_path: string
+        Path to the manifest. Need not exist.
+    output_path: string
+        Path to the converted file.
+    input_paths: list of strings
+        Paths to the files it was converted from.
+    params: dict
+        JSON-serialisable conversion parameters.
+
+    Returns
+    -------
+    is_current: bool
+
+    """
+
+    manifest = _load_manifest(manifest_path=manifest_path)
+
+    refreshed = []
+
+    is_current = _is_entry_current(
+        entry=manifest.get(os.path.abspath(output_path)),
+        output_path=output_path,
+        input_paths=input_paths,
+        params=params,
+        refreshed=refreshed
+    )
+
+    if refreshed:
+        _save_manifest(manifest_path=manifest_path, manifest=manifest)
+
+    return is_current
+
+
+def record_conversion(manifest_path, output_path, input_paths, params):
+    """Record a completed conversion in a conversion manifest.
+
+    Parameters are as for ``is_conversion_current``.
+
+    """
+
+    _record_conversions(
+        manifest_path=manifest_path,
+        conversions=[(output_path, input_paths, params)]
+    )
+
+
+def _load_manifest(manifest_path):
+    "Load a conversion manifest, or an empty one if it does not exist."
+
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def _record_conversions(manifest_path, conversions):
+    """Add (output_path, input_paths, params) conversions to a manifest, and
+    atomically replace it."""
+
+    manifest = _load_manifest(manifest_path=manifest_path)
+
+    for (output_path, input_paths, params) in conversions:
+
+        manifest[os.path.abspath(output_path)] = {
+            "inputs": {
+                os.path.abspath(input_path): _get_file_record(input_path)
+                for input_path in input_paths
+            },
+            "params": params,
+            "version": __version__
+        }
+
+    _save_manifest(manifest_path=manifest_path, manifest=manifest)
+
+
+def _save_manifest(manifest_path, manifest):
+    "Atomically replace a conversion manifest."
+
+    with _open_atomic(manifest_path) as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+
+@contextlib.contextmanager
+def _open_atomic(file_path, mode="w"):
+    """Open a temporary file next to ``file_path`` for writing, and move it
+    into place once it is successfully closed. Readers therefore never see a
+    partly-written file, and the file gets the same permissions as one made
+    with ``open``."""
+
+    tmp_file = tempfile.NamedTemporaryFile(
+        mode=mode,
+        dir=os.path.dirname(os.path.abspath(file_path)),
+        prefix=os.path.basename(file_path) + ".",
+        suffix=".tmp",
+        delete=False
+    )
+
+    try:
+
+        with tmp_file:
+            yield tmp_file
+
+        # temporary files are private to the user, so use the umask instead
+        umask = os.umask(0)
+        os.umask(umask)
+
+        os.chmod(tmp_file.name, 0o666 & ~umask)
+
+    except BaseException:
+        os.remove(tmp_file.name)
+        raise
+
+    os.replace(tmp_file.name, file_path)
+
+
+def _is_entry_current(entry, output_path, input_paths, params, refreshed):
+    """Check a single manifest entry against the current files and
+    parameters. Inputs found to be touched but unchanged get their new
+    modification time in the entry, and are appended to ``refreshed``."""
+
+    if (
+        entry is None or
+        not os.path.exists(output_path) or
+        entry["version"] != __version__ or
+        entry["params"] != params
+    ):
+        return False
+
+    inputs = entry["inputs"]
+
+    input_paths = [os.path.abspath(input_path) for input_path in input_paths]
+
+    if sorted(inputs) != sorted(input_paths):
+        return False
+
+    for input_path in input_paths:
+
+        try:
+            stat = os.stat(input_path)
+        except OSError:
+            return False
+
+        record = inputs[input_path]
+
+        if stat.st_size != record["size"]:
+            return False
+
+        # touched but possibly unchanged, so fall back to the content
+        if stat.st_mtime_ns != record["mtime_ns"]:
+
+            if _hash_file(input_path) != record["hash"]:
+                return False
+
+            record["mtime_ns"] = stat.st_mtime_ns
+
+            refreshed.append(input_path)
+
+    return True
+
+
+def _get_file_record(file_path):
+    "Size, modification time, and content hash of a file."
+
+    stat = os.stat(file_path)
+
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": _hash_file(file_path)
+    }
+
+
+def _hash_file(file_path, chunk_bytes=2 ** 20):
+    "BLAKE2 hash of the contents of a file, read in chunks."
+
+    file_hash = hashlib.blake2b()
+
+    with open(file_path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_bytes), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()